@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Run one default.py action the way Kodi does (a fresh process per click) and
+print its timings as JSON. Used by run.py; expects the stubs directory and
+the repository root on sys.path and the fake server in ESPN_BENCH_URL.
+"""
+import os
+import sys
+import json
+import time
+import resource
+
+start = time.time()
+sys.argv = ['plugin://plugin.video.espn-player/', '1', sys.argv[1]]
+import default
+imported = time.time()
+
+get_espn = default.get_espn
+
+
+def get_fake_espn():
+    """Point espnlib at the fake server before the client is created."""
+    if default._espn is None:
+        from resources.lib import espnlib
+        espnlib.BASE_URL = espnlib.NEULION_URL = os.environ['ESPN_BENCH_URL']
+        espnlib.CHANNEL_ART_URL = os.environ['ESPN_BENCH_URL'] + '/art/%s.png'
+    return get_espn()
+
+default.get_espn = get_fake_espn
+default.router(sys.argv[2][1:])
+rendered = time.time()
+
+import xbmcgui
+import xbmcplugin
+espn = default._espn
+print json.dumps({
+    'import': imported - start,
+    'render': rendered - imported,
+    'total': rendered - start,
+    'items': len(xbmcplugin.items) + len(xbmcplugin.resolved),
+    'kodi_calls': xbmcgui.calls[0] + xbmcplugin.calls[0],
+    'requests': len(espn.instrumentation.records) if espn else 0,
+    'http_stack_loaded': 'requests' in sys.modules,
+    'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+})
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for the ESPN Player and Neulion endpoints used by espnlib
+"""
+import os
+import json
+import time
+import threading
+import BaseHTTPServer
+import SocketServer
+from datetime import datetime, timedelta
+from urlparse import urlparse, parse_qs
+
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.respond(parse_qs(self.rfile.read(length)))
+
+    def respond(self, params):
+        espn = self.server.espn
+        path = urlparse(self.path).path
+        espn.hits.append(path)
+        time.sleep(espn.latency)
+        try:
+            status, headers, body = espn.handle(path, dict((key, values[0]) for key, values in params.items()),
+                                                self.headers)
+        except KeyError:
+            status, headers, body = 404, {}, 'not found'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeESPNPlayer(object):
+    """Serves schedule JSON, subscriptions and channels XML, espntoken,
+    dgetpkan, startSession and HLS playlists/segments on localhost.
+
+    Responses are synthesised in the shape of the real ones. A file named
+    after an endpoint (e.g. 'schedule.json', 'subscriptions.xml',
+    'startSession.xml') in fixtures_dir replaces the synthetic response, so
+    recorded responses can be replayed. latency is added to every request."""
+
+    def __init__(self, latency=0.0, games_per_month=300, variants=8, segment_size=256 * 1024,
+                 fixtures_dir=None):
+        self.latency = latency
+        self.games_per_month = games_per_month
+        self.variants = variants
+        self.segment_size = segment_size
+        self.fixtures_dir = fixtures_dir
+        self.hits = []
+        self.server = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    @property
+    def cdn_url(self):
+        """The same server under another host name, standing in for the manifest CDN."""
+        return 'http://localhost:%d' % self.server.server_address[1]
+
+    def start(self):
+        self.server = FakeServer(('127.0.0.1', 0), FakeRequestHandler)
+        self.server.espn = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fixture(self, name):
+        if self.fixtures_dir:
+            path = os.path.join(self.fixtures_dir, name)
+            if os.path.exists(path):
+                with open(path, 'rb') as fixture_file:
+                    return fixture_file.read()
+        return None
+
+    def handle(self, path, params, headers):
+        handlers = {
+            '/schedule': self.schedule,
+            '/account/subscriptions': self.subscriptions,
+            '/secure/authenticate': self.authenticate,
+            '/secure/espntoken': self.espntoken,
+            '/espngeo/dgetpkan': self.dgetpkan,
+            '/espngeo/startSession': self.start_session,
+            '/channels': self.channels,
+            '/hls/master.m3u8': self.master_playlist
+        }
+        if path.startswith('/hls/') and path.endswith('.m3u8') and path not in handlers:
+            return self.media_playlist(path)
+        if path.startswith('/hls/') and path.endswith('.ts'):
+            return 200, {'Content-Type': 'video/mp2t'}, 'G' * self.segment_size
+        if path.startswith('/art/'):
+            return 200, {'Content-Type': 'image/png'}, '\x89PNG' + '\x00' * 2048
+        return handlers[path](params, headers)
+
+    def schedule(self, params, headers):
+        body = self.fixture('schedule.json')
+        if body is None:
+            year, month = [int(part) for part in params['monthly'].split('-')]
+            now = datetime.utcnow()
+            first_day = datetime(year, month, 1)
+            games = []
+            for number in range(self.games_per_month):
+                start = first_day + timedelta(days=number % 28, hours=12 + number % 10)
+                if start.date() < now.date() or start < now - timedelta(hours=3):
+                    state = 3
+                elif start <= now:
+                    state = 1
+                else:
+                    state = 0
+                game = {
+                    'statsId': '%d%02d%04d' % (year, month, number),
+                    'name': 'Away Team %d vs. Home Team %d (Football)' % (number, number),
+                    'sportId': 'Football',
+                    'gameState': state,
+                    'dateTimeGMT': start.strftime('%Y-%m-%dT%H:%M:%S.000'),
+                    'image': 'http://a.espncdn.com/i/game%d.jpg?w=640' % number,
+                    'description': 'x' * 200
+                }
+                if number % 3:
+                    game['homeTeam'] = {'name': 'Home Team %d' % number, 'abbr': 'HT'}
+                    game['awayTeam'] = {'name': 'Away Team %d' % number, 'abbr': 'AT'}
+                if state != 0:
+                    game['availablePrograms'] = [{'id': number, 'type': 'full'}]
+                games.append(game)
+            body = json.dumps({'games': games})
+        return 200, {'Content-Type': 'application/json'}, body
+
+    def subscriptions(self, params, headers):
+        body = self.fixture('subscriptions.xml') or (
+            '<subscriptions><subs><sub><sku>NCAA_COLLEGE_PASS</sku><type>ncaa</type></sub></subs>'
+            '<leagues><league><type>ncaa</type><name>NCAA College Pass</name></league></leagues>'
+            '</subscriptions>')
+        return 200, {'Content-Type': 'text/xml', 'Set-Cookie': 'session=abc; Path=/; Max-Age=3600'}, body
+
+    def authenticate(self, params, headers):
+        return 200, {'Content-Type': 'text/xml'}, '<result><code>loginsuccess</code></result>'
+
+    def espntoken(self, params, headers):
+        body = self.fixture('espntoken.json') or json.dumps({'data': {
+            'airingId': params.get('airingId'), 'timestamp': '1', 'token': 't' * 64, 'userTrackName': 'user'}})
+        return 200, {'Content-Type': 'application/json'}, body
+
+    def dgetpkan(self, params, headers):
+        return 200, {'Content-Type': 'text/plain'}, self.fixture('dgetpkan.txt') or 'p' * 128
+
+    def start_session(self, params, headers):
+        body = self.fixture('startSession.xml') or (
+            '<user-verified-media-response><status-code>1</status-code><user-verified-event>'
+            '<user-verified-content><user-verified-media-item>'
+            '<url>%s/hls/master.m3u8</url><hls-backup-url>%s/hls/master.m3u8?backup=1</hls-backup-url>'
+            '<alt-url></alt-url></user-verified-media-item></user-verified-content></user-verified-event>'
+            '</user-verified-media-response>' % (self.cdn_url, self.cdn_url))
+        return 200, {'Content-Type': 'text/xml', 'Set-Cookie': '_mediaAuth=m; Path=/; Max-Age=28800'}, body
+
+    def channels(self, params, headers):
+        if headers.get('If-None-Match') == '"channels-v1"':
+            return 304, {'ETag': '"channels-v1"'}, ''
+        body = self.fixture('channels.xml') or (
+            '<result><channels>%s</channels></result>' % ''.join(
+                '<channel><name>Channel %d</name><seoName>channel%d</seoName></channel>' % (number, number)
+                for number in range(20)))
+        return 200, {'Content-Type': 'text/xml', 'ETag': '"channels-v1"'}, body
+
+    def master_playlist(self, params, headers):
+        body = self.fixture('master.m3u8')
+        if body is None:
+            lines = ['#EXTM3U']
+            for audio in range(6):
+                lines.append('#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="lang%d",URI="audio%d.m3u8"'
+                             % (audio, audio))
+            for variant in range(self.variants):
+                lines.append('#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=%d,RESOLUTION=1280x720,'
+                             'CODECS="avc1.4d401f,mp4a.40.2",AUDIO="aud"' % (400000 + variant * 600000))
+                lines.append('v%d/index.m3u8' % variant)
+            body = '\n'.join(lines) + '\n'
+        return 200, {'Content-Type': 'application/vnd.apple.mpegurl'}, body
+
+    def media_playlist(self, path):
+        segments = ''.join('#EXTINF:4.0,\nsegment%d.ts\n' % number for number in range(10))
+        body = '#EXTM3U\n#EXT-X-TARGETDURATION:4\n#EXT-X-MEDIA-SEQUENCE:0\n%s' % segments
+        return 200, {'Content-Type': 'application/vnd.apple.mpegurl'}, body
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks for espnlib and the default.py actions.
+
+Everything runs against FakeESPNPlayer on localhost with the xbmc modules
+stubbed out, so results only depend on this code, the configured latency
+and payload sizes. Usage:
+
+    python benchmarks/run.py [--latency 0.05] [--games 300] [--repeat 5]
+                             [--only micro|library|hls|actions]
+                             [--save baseline.json] [--compare baseline.json]
+
+--compare exits with status 1 when any timing or allocation count regressed
+by more than --tolerance compared to a previously saved run. The micro
+benchmarks first assert that the fixed-layout date parser agrees with
+strptime across the DST changes of DST_CHECK_ZONES.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import calendar
+import shutil
+import tempfile
+import argparse
+import subprocess
+from datetime import datetime, timedelta
+from urlparse import urljoin
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [os.path.join(REPO_DIR, 'resources', 'lib'), BENCH_DIR]
+
+from fake_server import FakeESPNPlayer
+import espnlib
+import hls
+
+# actions as Kodi would invoke them, run cold (empty profile) and warm
+ACTIONS = [
+    ('main_menu', '?action=main_menu&service=ncaa'),
+    ('list_today', '?action=list_today&service=ncaa'),
+    ('list_dates', '?action=list_dates&service=ncaa&day=archive'),
+    ('list_games', '?action=list_games&service=ncaa&filter_date=false&filter_games=false'),
+    ('list_channels', '?action=list_channels&service=ncaa'),
+    ('play_video', '?action=play_video&airingId=1'),
+]
+# time zones whose DST changes parse_datetime(localize=True) is checked against,
+# including half-hour offsets and Lord Howe's half-hour DST shift
+DST_CHECK_ZONES = ('America/New_York', 'Europe/London', 'America/St_Johns', 'Australia/Adelaide',
+                   'Australia/Lord_Howe')
+DST_CHECK_YEARS = (2017, 2018)
+
+
+def measure(func, repeat):
+    """Return the median wall time of func() and the gc-tracked objects it allocated and kept."""
+    timings = []
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    gc.collect()
+    timings.sort()
+    return {'seconds': timings[len(timings) // 2],
+            'objects': max(0, len(gc.get_objects()) - objects_before) // repeat}
+
+
+def new_client(server, profile_dir):
+    return espnlib.espnlib(os.path.join(profile_dir, 'cookie_file'), cache_dir=profile_dir,
+                           base_url=server.url, neulion_url=server.url)
+
+
+def strptime_to_local(date):
+    """Parse and localize an ESPN Player date the way espnlib did before its fixed-layout parser."""
+    return datetime.fromtimestamp(calendar.timegm(time.strptime(date, '%Y-%m-%dT%H:%M:%S.000')))
+
+
+def check_parse_datetime():
+    """Assert that parse_datetime(localize=True) matches strptime_to_local() every
+    half hour of DST_CHECK_YEARS in every zone of DST_CHECK_ZONES."""
+    first, last = datetime(DST_CHECK_YEARS[0], 1, 1), datetime(DST_CHECK_YEARS[-1] + 1, 1, 1)
+    dates = []
+    while first < last:
+        dates.append(first.strftime('%Y-%m-%dT%H:%M:%S.000'))
+        first += timedelta(minutes=30)
+    original_tz = os.environ.get('TZ')
+    mismatches = []
+    try:
+        for zone in DST_CHECK_ZONES:
+            os.environ['TZ'] = zone
+            time.tzset()
+            espnlib._utc_offsets.clear()
+            mismatches += [(zone, date) for date in dates
+                           if espnlib.parse_datetime(date, localize=True) != strptime_to_local(date)]
+    finally:
+        if original_tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = original_tz
+        time.tzset()
+        espnlib._utc_offsets.clear()
+    assert not mismatches, 'parse_datetime differs from strptime for %d dates, e.g. %s' % (
+        len(mismatches), mismatches[:5])
+
+
+def micro_benchmarks(args):
+    results = {}
+    check_parse_datetime()
+    dates = [(datetime(2018, 1, 1) + timedelta(minutes=37 * n)).strftime('%Y-%m-%dT%H:%M:%S.000')
+             for n in range(args.games * 2)]
+
+    def strptime_parse():
+        for date in dates:
+            strptime_to_local(date)
+
+    def fast_parse():
+        espnlib._utc_offsets.clear()
+        for date in dates:
+            espnlib.parse_datetime(date, localize=True)
+
+    results['parse_datetime.strptime'] = measure(strptime_parse, args.repeat)
+    results['parse_datetime.fixed_layout'] = measure(fast_parse, args.repeat)
+
+    server = FakeESPNPlayer(variants=40).start()
+    manifest = server.master_playlist({}, {})[2]
+    server.stop()
+    base_url = 'http://cdn.example.com/hls/master.m3u8'
+    results['master_playlist.hls'] = measure(
+        lambda: hls.parse_master_playlist(manifest.splitlines(), base_url), args.repeat)
+    try:
+        import m3u8
+        results['master_playlist.m3u8'] = measure(lambda: m3u8.loads(manifest).playlists, args.repeat)
+    except ImportError:
+        pass
+
+    server = FakeESPNPlayer().start()
+    documents = {
+        'subscriptions': (server.subscriptions({}, {})[2], espnlib.parse_subscription_skus),
+        'services': (server.subscriptions({}, {})[2], espnlib.parse_subscriptions),
+        'channels': (server.channels({}, {})[2], espnlib.parse_channels),
+        'start_session': (server.start_session({}, {})[2], espnlib.parse_media_item)
+    }
+    server.stop()
+    try:
+        import xmltodict
+    except ImportError:
+        xmltodict = None
+    for name, (document, extract) in documents.items():
+        results['xml.%s.iterparse' % name] = measure(lambda: [extract(document) for _ in range(100)], args.repeat)
+        if xmltodict:
+            results['xml.%s.xmltodict' % name] = measure(
+                lambda: [xmltodict.parse(document) for _ in range(100)], args.repeat)
+    return results
+
+
+def library_benchmarks(args, server):
+    results = {}
+    profile_dir = tempfile.mkdtemp()
+    try:
+        def cold_games():
+            shutil.rmtree(profile_dir)
+            os.mkdir(profile_dir)
+            new_client(server, profile_dir).get_games('ncaa')
+
+        results['get_games.cold'] = measure(cold_games, args.repeat)
+        espn = new_client(server, profile_dir)
+        results['get_games.cached'] = measure(lambda: new_client(server, profile_dir).get_games('ncaa'), args.repeat)
+        results['get_gamedates.cached'] = measure(lambda: espn.get_gamedates('ncaa', 'archive'), args.repeat)
+        results['get_games.filter_date'] = measure(
+            lambda: espn.get_games('ncaa', filter_date=datetime.now().date()), args.repeat)
+        results['sync_schedule'] = measure(lambda: espn.sync_schedule('ncaa', max_age=0), args.repeat)
+        results['login.cached'] = measure(lambda: espn.login('user', 'secret'), args.repeat)
+        results['resolve_stream'] = measure(lambda: espn.resolve_stream('1', username='user', password='secret'),
+                                            args.repeat)
+        results['parse_m3u8_manifest'] = measure(
+            lambda: espn.parse_m3u8_manifest(server.url + '/hls/master.m3u8'), args.repeat)
+        results['get_channels.cold'] = measure(
+            lambda: new_client(server, tempfile.mkdtemp()).get_channels('ncaa'), args.repeat)
+    finally:
+        shutil.rmtree(profile_dir, ignore_errors=True)
+    return results
+
+
+def hls_benchmarks(args, server):
+    """Play the segments of a media playlist directly and through HLSProxy,
+    one after the other like a player does, and check that the proxy fetches
+    every segment upstream once and refuses URLs on other hosts."""
+    results = {}
+    session = requests.Session()
+    headers = {'Cookie': '_mediaAuth=m'}
+    playlist_url = server.url + '/hls/v0/index.m3u8'
+
+    def play(session, url, headers=None):
+        def get(url):
+            req = session.get(url, headers=headers)
+            req.raise_for_status()
+            return req.content
+
+        for line in get(url).splitlines():
+            if line and not line.startswith('#'):
+                get(urljoin(url, line))
+
+    # a fresh proxy (with an empty segment cache) for every repetition, started
+    # and stopped outside of the timing
+    proxies = []
+    for _ in range(args.repeat):
+        proxies.append(hls.HLSProxy(requests.Session(), headers=headers, prefetch_segments=3))
+        proxies[-1].start()
+    proxy_session = requests.Session()
+    stopped = []
+
+    def play_proxied():
+        proxy = proxies.pop()
+        play(proxy_session, proxy.proxy_url(playlist_url))
+        stopped.append(proxy)
+
+    results['hls.direct'] = measure(lambda: play(session, playlist_url, headers), args.repeat)
+    hits = len(server.hits)
+    results['hls.proxy'] = measure(play_proxied, args.repeat)
+    for proxy in stopped:
+        proxy.stop()
+    session.close()
+    proxy_session.close()
+    segment_hits = [path for path in server.hits[hits:] if path.endswith('.ts')]
+    assert len(segment_hits) == len(set(segment_hits)) * args.repeat, \
+        'HLSProxy downloaded segments more than once: %s' % segment_hits
+
+    proxy = hls.HLSProxy(requests.Session(), headers=headers)
+    proxy.start()
+    try:
+        proxy.proxy_url(playlist_url)
+        status = requests.get('http://127.0.0.1:%d/segment' % proxy.server.server_address[1],
+                              params={'u': 'http://example.com/segment0.ts'}).status_code
+    finally:
+        proxy.stop()
+    assert status == 403, 'HLSProxy proxied a URL on another host (status %d)' % status
+    return results
+
+
+def action_benchmarks(args, server):
+    results = {}
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(BENCH_DIR, 'stubs'), REPO_DIR, env.get('PYTHONPATH', '')])
+    env['ESPN_BENCH_URL'] = server.url
+    for name, query in ACTIONS:
+        for run in ('cold', 'warm'):
+            samples = []
+            profile_dir = None
+            try:
+                for repetition in range(args.repeat):
+                    if run == 'cold' or repetition == 0:  # every cold run starts from an empty profile
+                        if profile_dir:
+                            shutil.rmtree(profile_dir, ignore_errors=True)
+                        profile_dir = env['ESPN_BENCH_PROFILE'] = tempfile.mkdtemp()
+                        if run == 'warm':  # fill the caches first
+                            subprocess.check_output([sys.executable, os.path.join(BENCH_DIR, 'action.py'), query],
+                                                    env=env, cwd=REPO_DIR)
+                    output = subprocess.check_output([sys.executable, os.path.join(BENCH_DIR, 'action.py'), query],
+                                                     env=env, cwd=REPO_DIR)
+                    samples.append(json.loads(output.strip().splitlines()[-1]))
+            finally:
+                if profile_dir:
+                    shutil.rmtree(profile_dir, ignore_errors=True)
+            samples.sort(key=lambda sample: sample['total'])
+            median = samples[len(samples) // 2]
+            results['action.%s.%s' % (name, run)] = {
+                'seconds': median['total'],
+                'max_seconds': samples[-1]['total'],
+                'import_seconds': median['import'],
+                'requests': median['requests'],
+                'kodi_calls': median['kodi_calls'],
+                'maxrss_kb': median['maxrss_kb'],
+                'http_stack_loaded': median['http_stack_loaded']
+            }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of regressions of results against baseline."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        for metric in ('seconds', 'objects', 'requests', 'kodi_calls'):
+            if metric in result and metric in previous and previous[metric]:
+                if result[metric] > previous[metric] * tolerance:
+                    regressions.append('%s %s: %s -> %s' % (name, metric, previous[metric], result[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every fake response')
+    parser.add_argument('--games', type=int, default=300, help='games per schedule month')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', choices=('micro', 'library', 'hls', 'actions'))
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against results saved with --save')
+    parser.add_argument('--tolerance', type=float, default=1.3, help='allowed slowdown factor')
+    args = parser.parse_args()
+
+    results = {}
+    if args.only in (None, 'micro'):
+        results.update(micro_benchmarks(args))
+    if args.only in (None, 'library', 'hls', 'actions'):
+        server = FakeESPNPlayer(latency=args.latency, games_per_month=args.games).start()
+        try:
+            if args.only in (None, 'library'):
+                results.update(library_benchmarks(args, server))
+            if args.only in (None, 'hls'):
+                results.update(hls_benchmarks(args, server))
+            if args.only in (None, 'actions'):
+                results.update(action_benchmarks(args, server))
+        finally:
+            server.stop()
+
+    for name, result in sorted(results.items()):
+        extra = ', '.join('%s=%s' % (key, value) for key, value in sorted(result.items()) if key != 'seconds')
+        print '%-40s %9.2f ms  %s' % (name, result['seconds'] * 1000, extra)
+
+    if args.save:
+        with open(args.save, 'wb') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'rb') as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print 'REGRESSION: %s' % regression
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
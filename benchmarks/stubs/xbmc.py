@@ -0,0 +1,32 @@
+"""Minimal stand-in for Kodi's xbmc module, used by the benchmarks."""
+LOGDEBUG = 0
+LOGNOTICE = 2
+
+
+def translatePath(path):
+    return path
+
+
+def log(msg, level=LOGDEBUG):
+    pass
+
+
+def executebuiltin(function):
+    pass
+
+
+def getInfoLabel(label):
+    return ''
+
+
+class Player(object):
+    def isPlaying(self):
+        return False
+
+
+class Monitor(object):
+    def abortRequested(self):
+        return False
+
+    def waitForAbort(self, timeout=0):
+        return True
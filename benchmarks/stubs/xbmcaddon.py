@@ -0,0 +1,46 @@
+"""Minimal stand-in for Kodi's xbmcaddon module, used by the benchmarks.
+The profile directory and settings come from the ESPN_BENCH_PROFILE and
+ESPN_BENCH_SETTINGS (JSON) environment variables."""
+import os
+import re
+import json
+import tempfile
+
+STRINGS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                            'resources', 'language', 'English', 'strings.po')
+
+DEFAULT_SETTINGS = {
+    'email': 'user@example.com',
+    'password': 'secret',
+    'preferred_bitrate': '0',
+    'max_bitrate_allowed': '5000',
+    'debug': 'false',
+    'verify_ssl': 'true',
+    'games_per_page': '100'
+}
+_strings = {}
+
+
+class Addon(object):
+    def __init__(self, id=None):
+        self.profile = os.environ.get('ESPN_BENCH_PROFILE') or tempfile.mkdtemp()
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(json.loads(os.environ.get('ESPN_BENCH_SETTINGS', '{}')))
+
+    def getAddonInfo(self, key):
+        return {
+            'id': 'plugin.video.espn-player',
+            'version': 'benchmark',
+            'path': os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+            'profile': self.profile
+        }[key]
+
+    def getSetting(self, key):
+        return self.settings.get(key, '')
+
+    def getLocalizedString(self, string_id):
+        if not _strings:
+            with open(STRINGS_FILE) as strings_file:
+                for number, text in re.findall(r'msgctxt "#(\d+)"\s+msgid "(.*)"', strings_file.read()):
+                    _strings[int(number)] = text.decode('utf-8')
+        return _strings.get(string_id, u'string %d' % string_id)
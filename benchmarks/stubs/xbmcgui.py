@@ -0,0 +1,42 @@
+"""Minimal stand-in for Kodi's xbmcgui module, used by the benchmarks.
+Every ListItem call is counted in 'calls', as each one is a round-trip into
+Kodi in the real module."""
+calls = [0]
+
+
+class ListItem(object):
+    def __init__(self, label='', label2='', path='', offscreen=False):
+        calls[0] += 1
+        self.label = label
+        self.path = path
+        self.properties = {}
+        self.art = {}
+        self.info = {}
+
+    def setProperty(self, key, value):
+        calls[0] += 1
+        self.properties[key] = value
+
+    def setArt(self, art):
+        calls[0] += 1
+        self.art.update(art)
+
+    def setInfo(self, type, infoLabels):
+        calls[0] += 1
+        self.info.update(infoLabels)
+
+    def addStreamInfo(self, type, values):
+        calls[0] += 1
+        pass
+
+    def setContentLookup(self, enable):
+        calls[0] += 1
+        pass
+
+
+class Dialog(object):
+    def ok(self, heading, line1, *lines):
+        return True
+
+    def select(self, heading, options, *args, **kwargs):
+        return 0
@@ -0,0 +1,41 @@
+"""Minimal stand-in for Kodi's xbmcplugin module, used by the benchmarks.
+Everything added to a directory is kept in 'items' and every call that
+touches a directory is counted in 'calls'."""
+SORT_METHOD_NONE = 0
+SORT_METHOD_LABEL = 1
+SORT_METHOD_DATE = 3
+SORT_METHOD_GENRE = 16
+SORT_METHOD_UNSORTED = 40
+
+items = []
+resolved = []
+calls = [0]
+
+
+def addDirectoryItem(handle, url, listitem, isFolder=False, totalItems=0):
+    calls[0] += 1
+    items.append((url, listitem, isFolder))
+    return True
+
+
+def addDirectoryItems(handle, directory_items, totalItems=0):
+    calls[0] += 1
+    items.extend(directory_items)
+    return True
+
+
+def endOfDirectory(handle, succeeded=True, updateListing=False, cacheToDisc=True):
+    calls[0] += 1
+
+
+def setResolvedUrl(handle, succeeded, listitem):
+    calls[0] += 1
+    resolved.append(listitem)
+
+
+def setContent(handle, content):
+    calls[0] += 1
+
+
+def addSortMethod(handle, sortMethod, label2Mask=''):
+    calls[0] += 1
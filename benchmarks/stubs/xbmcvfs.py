@@ -0,0 +1,11 @@
+"""Minimal stand-in for Kodi's xbmcvfs module, used by the benchmarks."""
+import os
+
+
+def exists(path):
+    return os.path.exists(path)
+
+
+def mkdir(path):
+    os.makedirs(path)
+    return True
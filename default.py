@@ -6,11 +6,8 @@ import sys
 import os
 import urllib
 import urlparse
-import re
 from datetime import datetime
 
-from resources.lib.espnlib import espnlib
-
 import xbmc
 import xbmcaddon
 import xbmcvfs
@@ -22,6 +19,8 @@ addon_path = xbmc.translatePath(addon.getAddonInfo('path'))
 addon_profile = xbmc.translatePath(addon.getAddonInfo('profile'))
 language = addon.getLocalizedString
 logging_prefix = '[%s-%s]' % (addon.getAddonInfo('id'), addon.getAddonInfo('version'))
+default_art = {'icon': os.path.join(addon_path, 'icon.png'), 'fanart': os.path.join(addon_path, 'fanart.jpg')}
+unknown_duration = {'duration': 0}
 
 if not xbmcvfs.exists(addon_profile):
     xbmcvfs.mkdir(addon_profile)
@@ -43,7 +42,54 @@ if addon.getSetting('verify_ssl') == 'false':
 else:
     verify_ssl = True
 
-espn = espnlib(cookie_file, debug, verify_ssl)
+if addon.getSetting('schedule_next_month') == 'true':
+    schedule_window = (-1, 1)
+else:
+    schedule_window = (-1, 0)
+
+max_prefetched_tokens = 8
+
+try:
+    games_per_page = int(addon.getSetting('games_per_page'))
+except ValueError:
+    games_per_page = 100
+
+# schedules, channels and artwork can be shared by several installations
+cache_dir = xbmc.translatePath(addon.getSetting('shared_cache_dir')) or addon_profile
+
+profiling = addon.getSetting('profiling') == 'true'
+timings_file = os.path.join(addon_profile, 'timings.log')
+
+_espn = None
+_action = 'root'
+_timings_reported = False
+
+
+def get_espn():
+    """Return the espnlib client, importing and creating it on first use so
+    that actions without network access never load the HTTP stack."""
+    global _espn
+    if _espn is None:
+        from resources.lib.espnlib import espnlib
+        _espn = espnlib(cookie_file, debug, verify_ssl, cache_dir=cache_dir, schedule_window=schedule_window)
+        _espn.instrumentation.begin_action(_action)
+    return _espn
+
+
+def report_timings():
+    """Log the request timings of the current action and, if profiling is
+    enabled, append them to the timings file. Only reports once per action."""
+    global _timings_reported
+    if _espn is None or _timings_reported:
+        return
+    _timings_reported = True
+    addon_log(_espn.instrumentation.summary())
+    if profiling:
+        _espn.instrumentation.dump(timings_file)
+        latency = _espn.instrumentation.tail_latency(timings_file, _action)
+        if latency and _action in ('play_video', 'play_channel'):
+            addon_log('%s start latency over %d runs: p50 %.2fs, p90 %.2fs, p99 %.2fs, max %.2fs' % (
+                _action, latency['count'], latency['p50'], latency['p90'], latency['p99'], latency['max']))
 
 
 def addon_log(string):
@@ -52,15 +98,17 @@ def addon_log(string):
 
 
 def services_menu():
+    espn = get_espn()
     services = espn.get_services()
     if len(services) == 1:
         # list main menu directly if one service is found
         main_menu(services.values()[0])
     else:
+        items = []
         for name, service in services.items():
             parameters = {'action': 'main_menu', 'service': service}
-            add_item(name, parameters)
-        xbmcplugin.endOfDirectory(_handle)
+            add_item(name, parameters, items)
+        end_directory(items)
 
 
 def main_menu(service):
@@ -79,11 +127,12 @@ def main_menu(service):
                 day = 'archive'
             parameters = {'action': 'list_dates', 'service': service, 'day': day}
 
-        add_item(item, parameters)
-    xbmcplugin.endOfDirectory(_handle)
+        add_item(item, parameters, listing)
+    end_directory(listing)
 
 
 def list_today(service):
+    listing = []
     now = datetime.now()
     date_today = now.date()
     items = [language(30015), language(30016), language(30017)]
@@ -99,80 +148,95 @@ def list_today(service):
             parameters = {'action': 'list_games', 'service': service, 'filter_date': date_today,
                           'filter_games': game_type}
 
-        add_item(item, parameters)
-    xbmcplugin.endOfDirectory(_handle)
+        add_item(item, parameters, listing)
+    end_directory(listing)
 
 
 def list_dates(service, day):
+    espn = get_espn()
     dates = espn.get_gamedates(service, day)
+    items = []
     for date in dates:
         title = date.strftime('%Y-%m-%d')
         parameters = {'action': 'list_games', 'service': service, 'filter_date': date, 'filter_games': 'false'}
-        add_item(title, parameters)
-    xbmcplugin.endOfDirectory(_handle)
+        add_item(title, parameters, items)
+    end_directory(items, sort_methods=(xbmcplugin.SORT_METHOD_UNSORTED, xbmcplugin.SORT_METHOD_LABEL))
 
 
-def list_games(service, filter_date, filter_games):
+def list_games(service, filter_date, filter_games, offset=0, sport_id=None):
+    espn = get_espn()
     items = []
     if filter_date == 'false':
         filter_date = False
     if filter_games == 'false':
         filter_games = False
 
-    games = espn.get_games(service, filter_date=filter_date, filter_games=filter_games)
+    # render the last known schedule right away and revalidate it after the listing is shown
+    games, total = espn.query_games(service, filter_date=filter_date, filter_games=filter_games, sport_id=sport_id,
+                                    offset=offset, limit=games_per_page or None, allow_stale=True)
+    live_airings = []
+    shared_art = {}  # one art dict per distinct image
 
     for game in games:
-        team_names = True
-        game_datetime = espn.parse_datetime(game['dateTimeGMT'], localize=True)
-        time = game_datetime.strftime('%H:%M')
-        time_and_date = game_datetime.strftime('%Y-%m-%d %H:%M')
-        category = game['sportId']
+        time = game.start.strftime('%H:%M')
+        category = game.sport_id
 
-        try:
-            home_team = '%s' % (game['homeTeam']['name'])
-            away_team = '%s' % (game['awayTeam']['name'])
-        except KeyError:
-            # try to extract team names from full title
-            teampattern = re.search(r'(.+)( vs. )(.+)( \()', game['name'])
-            if teampattern:
-                home_team = teampattern.group(3)
-                away_team = teampattern.group(1)
-            else:
-                team_names = False
-
-        if 'availablePrograms' not in game:
-            playable = False
+        if not game.playable:
             parameters = {'action': 'null'}
         else:
-            playable = True
-            parameters = {'action': 'play_video', 'airingId': game['statsId']}
+            parameters = {'action': 'play_video', 'airingId': game.stats_id}
+            if game.state == 1:
+                live_airings.append(game.stats_id)
 
-        if team_names:
-            title = '[B]%s[/B] vs. [B]%s[/B]' % (away_team, home_team)
-            list_title = '[B]%s[/B] %s: [B]%s[/B] vs. [B]%s[/B]' % (coloring(time, 'time'), coloring(category, 'cat'), away_team, home_team)
+        if game.home_team:
+            title = '[B]%s[/B] vs. [B]%s[/B]' % (game.away_team, game.home_team)
+            list_title = '[B]%s[/B] %s: [B]%s[/B] vs. [B]%s[/B]' % (coloring(time, 'time'), coloring(category, 'cat'), game.away_team, game.home_team)
 
         else:
-            title = '[B]%s[/B]' % game['name']
-            list_title = '[B]%s[/B] %s: [B]%s[/B]' % (coloring(time, 'time'), coloring(category, 'cat'), game['name'])
-
-        game_image = game['image'].split('.jpg')[0] + '.jpg'
+            title = '[B]%s[/B]' % game.name
+            list_title = '[B]%s[/B] %s: [B]%s[/B]' % (coloring(time, 'time'), coloring(category, 'cat'), game.name)
 
-        art = {
-            'thumb': game_image,
-            'fanart': game_image,
-            'cover': game_image,
-        }
+        art = shared_art.get(game.image)
+        if art is None:
+            art = shared_art[game.image] = {
+                'thumb': game.image,
+                'fanart': game.image,
+                'cover': game.image,
+            }
 
         info = {
             'title': title,
             'genre': category,
-            'plot': game['name']
+            'plot': game.name
         }
 
-        items = add_item(list_title, parameters, items=items, playable=playable, folder=False, set_art=art,
-                         set_info=info)
-    xbmcplugin.addDirectoryItems(_handle, items, len(items))
-    xbmcplugin.endOfDirectory(_handle)
+        add_item(list_title, parameters, items, playable=game.playable, folder=False, set_art=art, set_info=info)
+
+    if offset + len(games) < total:
+        parameters = {'action': 'list_games', 'service': service, 'filter_date': filter_date or 'false',
+                      'filter_games': filter_games or 'false', 'offset': offset + len(games)}
+        if sport_id:
+            parameters['sport'] = sport_id
+        page_count = (total + games_per_page - 1) // games_per_page
+        add_item(language(30028) % (offset // games_per_page + 2, page_count), parameters, items,
+                 properties={'SpecialSort': 'bottom'})
+    end_directory(items, content='videos', sort_methods=(xbmcplugin.SORT_METHOD_UNSORTED,
+                                                         xbmcplugin.SORT_METHOD_LABEL,
+                                                         xbmcplugin.SORT_METHOD_GENRE))
+    revalidation = espn.revalidate_schedule(service)
+    if live_airings:
+        # warm up playback tokens for live games while the user is browsing
+        espn.prefetch_tokens(live_airings[:max_prefetched_tokens])
+    if revalidation:
+        try:
+            changed = revalidation.result()
+        except Exception as error:
+            addon_log('Schedule revalidation failed: %s' % error)
+            return
+        # only refresh this listing, not whatever the user moved on to in the meantime
+        listing_shown = xbmc.getInfoLabel('Container.FolderPath') == _url + sys.argv[2]
+        if changed and listing_shown and not xbmc.Player().isPlaying():
+            xbmc.executebuiltin('Container.Refresh')
 
 
 def coloring(text, meaning):
@@ -187,118 +251,179 @@ def coloring(text, meaning):
 
 def list_channels(service):
     """List all channels from the returned dict."""
+    espn = get_espn()
     channels = espn.get_channels(service)
+    items = []
 
     for name, channel_id in channels.items():
-        listitem = xbmcgui.ListItem(label=name)
-        listitem.setProperty('IsPlayable', 'true')
-        art = {'thumb': 'http://a.espncdn.com/prod/assets/watchespn/appletv/images/channels-carousel/%s.png' % channel_id}
+        art = {'thumb': espn.get_channel_art(channel_id)}
         # airingId is seoName for live channels
         parameters = {'action': 'play_channel', 'airingId': channel_id, 'channel': channel_id}
-        add_item(name, parameters, playable=True, set_art=art)
-    xbmcplugin.endOfDirectory(_handle)
+        add_item(name, parameters, items, playable=True, set_art=art)
+    end_directory(items, content='videos', sort_methods=(xbmcplugin.SORT_METHOD_LABEL,))
+    espn.prefetch_channel_art(channels.values())
 
 
 def play_video(airingId, channel=None):
+    espn = get_espn()
     try:
-      espn.login(username, password)
+        if channel:
+            stream_url = espn.resolve_stream(airingId, channel, username=username, password=password)
+        else:
+            stream_url = espn.resolve_stream(airingId, username=username, password=password)
     except espn.LoginFailure:
-      addon_log('login failed')
-      dialog = xbmcgui.Dialog()
-      dialog.ok(language(30005),
-                language(30006))
+        addon_log('login failed')
+        dialog = xbmcgui.Dialog()
+        dialog.ok(language(30005),
+                  language(30006))
+        return
 
-    if channel:
-        stream_url = espn.get_stream_url(airingId, channel)
-    else:
-        stream_url = espn.get_stream_url(airingId)
     if stream_url['bitrates']:
-        bitrate = select_bitrate(stream_url['bitrates'].keys())
-        if bitrate:
-            play_url = stream_url['bitrates'][bitrate]
+        variant = select_bitrate(stream_url['bitrates'], stream_url['auth_cookie'])
+        if variant:
+            proxy = None
+            if addon.getSetting('use_proxy') == 'true':
+                from resources.lib.hls import HLSProxy
+                proxy = HLSProxy(espn.http_session, headers={'Cookie': stream_url['auth_cookie']},
+                                 prefetch_segments=int(addon.getSetting('proxy_prefetch_segments')),
+                                 verify_ssl=verify_ssl, log=addon_log, on_download=espn.throughput.add_sample,
+                                 on_forbidden=lambda: espn.invalidate_stream(airingId, channel or 'espn3'))
+                proxy.start()
+                play_url = proxy.proxy_url(variant['url'])
+            else:
+                play_url = variant['play_url']
             playitem = xbmcgui.ListItem(path=play_url)
             playitem.setProperty('IsPlayable', 'true')
             xbmcplugin.setResolvedUrl(_handle, True, listitem=playitem)
+            report_timings()
+            if proxy:
+                serve_until_stopped(proxy)
     else:
         dialog = xbmcgui.Dialog()
         dialog.ok(language(30005), language(30013))
 
 
-def ask_bitrate(bitrates):
-    """Presents a dialog for user to select from a list of bitrates.
-    Returns the value of the selected bitrate."""
+def serve_until_stopped(proxy, start_timeout=30):
+    """Keep the plugin process (and the HLS proxy) alive while the stream plays."""
+    espn = get_espn()
+    player = xbmc.Player()
+    monitor = xbmc.Monitor()
+    waited = 0
+    while not player.isPlaying() and waited < start_timeout:
+        if monitor.waitForAbort(1):
+            break
+        waited += 1
+    while player.isPlaying() and not monitor.abortRequested():
+        monitor.waitForAbort(1)
+    proxy.stop()
+    espn.throughput.save()
+    addon_log('HLS proxy stopped.')
+
+
+def ask_bitrate(variants):
+    """Presents a dialog for user to select from a list of variants.
+    Returns the selected variant."""
     options = []
-    for bitrate in bitrates:
-        options.append(bitrate + ' Kbps')
+    for variant in variants:
+        if variant['resolution']:
+            options.append('%d Kbps (%s)' % (variant['bitrate'], variant['resolution']))
+        else:
+            options.append('%d Kbps' % variant['bitrate'])
     dialog = xbmcgui.Dialog()
     ret = dialog.select(language(30010), options)
     if ret > -1:
-        return bitrates[ret]
+        return variants[ret]
 
 
-def select_bitrate(manifest_bitrates=None):
-    """Returns a bitrate while honoring the user's preference."""
+def select_bitrate(variants, auth_cookie=None):
+    """Returns a variant while honoring the user's preference.
+    variants are expected to be ordered by bandwidth, highest first."""
+    espn = get_espn()
     bitrate_setting = int(addon.getSetting('preferred_bitrate'))
     if bitrate_setting == 0:
         preferred_bitrate = 'highest'
     elif bitrate_setting == 1:
         preferred_bitrate = 'limit'
+    elif bitrate_setting == 3:
+        preferred_bitrate = 'auto'
     else:
         preferred_bitrate = 'ask'
 
-    manifest_bitrates.sort(key=int, reverse=True)
-    if preferred_bitrate == 'highest':
-        return manifest_bitrates[0]
+    if preferred_bitrate == 'auto':
+        if not espn.throughput.recent():
+            # nothing measured lately (segments only pass through us with the proxy on)
+            try:
+                espn.probe_throughput(variants[0], auth_cookie)
+            except Exception as error:
+                addon_log('Auto bitrate: timing a segment failed: %s' % error)
+        variant = espn.throughput.select_variant(variants)
+        if variant:
+            addon_log('Auto bitrate: picked %d Kbps for an estimated %d Kbps.' % (
+                variant['bitrate'], espn.throughput.estimate / 1000))
+            return variant
+        addon_log('Auto bitrate: no throughput measured yet, using the highest bitrate.')
+        return variants[0]
+    elif preferred_bitrate == 'highest':
+        return variants[0]
     elif preferred_bitrate == 'limit':
-        allowed_bitrates = []
         max_bitrate_allowed = int(addon.getSetting('max_bitrate_allowed'))
-        for bitrate in manifest_bitrates:
-            if max_bitrate_allowed >= int(bitrate):
-                allowed_bitrates.append(str(bitrate))
-        if allowed_bitrates:
-            return allowed_bitrates[0]
+        for variant in variants:
+            if max_bitrate_allowed >= variant['bitrate']:
+                return variant
     else:
-        return ask_bitrate(manifest_bitrates)
+        return ask_bitrate(variants)
 
 
-def add_item(title, parameters, items=False, folder=True, playable=False, set_info=False, set_art=False,
-             watched=False, set_content=False):
+def add_item(title, parameters, items, folder=True, playable=False, set_info=False, set_art=False,
+             watched=False, properties=None):
+    """Append a (url, ListItem, isFolder) entry to items. Return items."""
     listitem = xbmcgui.ListItem(label=title)
+    for key, value in (properties or {}).items():
+        listitem.setProperty(key, value)
     if playable:
         listitem.setProperty('IsPlayable', 'true')
+        listitem.setContentLookup(False)  # allows sending custom headers/cookies to ffmpeg
         folder = False
-    if set_art:
-        listitem.setArt(set_art)
-    else:
-        listitem.setArt({'icon': os.path.join(addon_path, 'icon.png')})
-        listitem.setArt({'fanart': os.path.join(addon_path, 'fanart.jpg')})
+    listitem.setArt(set_art or default_art)
     if set_info:
         listitem.setInfo('video', set_info)
     if not watched:
-        listitem.addStreamInfo('video', {'duration': 0})
-    if set_content:
-        xbmcplugin.setContent(_handle, set_content)
+        listitem.addStreamInfo('video', unknown_duration)
 
-    listitem.setContentLookup(False)  # allows sending custom headers/cookies to ffmpeg
-    recursive_url = _url + '?' + urllib.urlencode(parameters)
+    items.append((_url + '?' + urllib.urlencode(parameters), listitem, folder))
+    return items
 
-    if items is False:
-        xbmcplugin.addDirectoryItem(_handle, recursive_url, listitem, folder)
-    else:
-        items.append((recursive_url, listitem, folder))
-        return items
+
+def end_directory(items, content=None, sort_methods=()):
+    """Add all entries to the directory in a single call and close it."""
+    if content:
+        xbmcplugin.setContent(_handle, content)
+    for sort_method in sort_methods:
+        xbmcplugin.addSortMethod(_handle, sort_method)
+    xbmcplugin.addDirectoryItems(_handle, items, len(items))
+    xbmcplugin.endOfDirectory(_handle)
 
 
 def router(paramstring):
     """Router function that calls other functions depending on the provided paramstring."""
+    global _action
     params = dict(urlparse.parse_qsl(paramstring))
+    _action = params.get('action', 'root')
+    try:
+        route(params)
+    finally:
+        report_timings()
+
+
+def route(params):
     if params:
         if params['action'] == 'main_menu':
             main_menu(params['service'])
         elif params['action'] == 'list_channels':
             list_channels(params['service'])
         elif params['action'] == 'list_games':
-            list_games(params['service'], params['filter_date'], params['filter_games'])
+            list_games(params['service'], params['filter_date'], params['filter_games'],
+                       int(params.get('offset', 0)), params.get('sport'))
             addon_log(params)
         elif params['action'] == 'play_video':
             play_video(params['airingId'])
@@ -310,6 +435,7 @@ def router(paramstring):
             list_today(params['service'])
 
     else:
+        espn = get_espn()
         try:
             espn.login(username, password)
             services_menu()
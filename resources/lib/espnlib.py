@@ -2,26 +2,732 @@
 """
 A Kodi-agnostic library for ESPN Player
 """
+import os
+import re
+import sys
 import json
 import codecs
 import cookielib
-import calendar
 from datetime import datetime, timedelta
 import time
+import random
+import tempfile
+import threading
+import Queue
+import functools
 from urllib import urlencode
+from urlparse import urlparse, urljoin
+from cStringIO import StringIO
+import xml.etree.cElementTree as ElementTree
 
 import requests
-import m3u8
-import xmltodict
+from requests.packages.urllib3.util.retry import Retry
+
+from instrumentation import Instrumentation, InstrumentedAdapter
+
+
+# seconds a cached schedule month stays fresh, by the state of its games
+SCHEDULE_TTL = {
+    0: 900,  # upcoming
+    1: 60,  # inplay
+    3: 86400  # archive
+}
+SCHEDULE_TTL_EMPTY = 900
+# bumped whenever the layout of cached schedule months changes
+SCHEDULE_CACHE_VERSION = 2
+# seconds between background schedule refreshes while games are in play, and
+# the bounds of the exponential back-off used while nothing is live
+REFRESH_INPLAY = 60
+REFRESH_IDLE_MIN = 300
+REFRESH_IDLE_MAX = 3600
+# seconds after which sync_schedule refetches the months around today
+SYNC_MAX_AGE = 300
+# (connect, read) timeout in seconds for every request, and tighter budgets
+# for the endpoints on the playback start path
+DEFAULT_TIMEOUT = (5, 20)
+ENDPOINT_TIMEOUTS = {
+    '/account/subscriptions': (3.05, 10),
+    '/secure/espntoken': (3.05, 8),
+    '/espngeo/dgetpkan': (3.05, 8),
+    '/espngeo/startSession': (3.05, 10),
+    '/channels': (3.05, 10)
+}
+# the first retry is immediate (urllib3 1.x has no back-off for it), later ones
+# back off by RETRY_BACKOFF * 2 ** (retry - 1) seconds, randomised by +/-
+# RETRY_JITTER of that; POSTs are only retried when the connection couldn't be
+# established
+RETRY_BACKOFF = 0.3
+RETRY_JITTER = 0.5
+RETRY_STATUSES = (502, 503, 504)
+# startSession fields that may hold a manifest URL
+MANIFEST_KINDS = (('url', 'primary'), ('hls-backup-url', 'backup'), ('alt-url', 'alternative'))
+# seconds after which a second copy of a still unanswered idempotent GET is
+# sent; whichever response arrives first is used
+HEDGE_DELAYS = {
+    '/schedule': 2.0,
+    '/channels': 1.5
+}
+BASE_URL = 'https://www.espnplayer.com'
+NEULION_URL = 'https://neulion.go.com'
+# responses longer than this are truncated in the debug log
+LOG_BODY_LIMIT = 1024
+# seconds the stored channel list is used before it's revalidated, and
+# seconds downloaded channel artwork is kept before it's downloaded again
+CHANNELS_TTL = 3600
+CHANNEL_ART_TTL = 604800
+CHANNEL_ART_URL = 'http://a.espncdn.com/prod/assets/watchespn/appletv/images/channels-carousel/%s.png'
+# seconds a prefetched playback token is kept before it's considered stale
+TOKEN_TTL = 120
+# seconds a playback session requested from startSession stays valid; resolved
+# streams are reused until then or until the _mediaAuth cookie expires
+SESSION_TTL = 480
+# seconds after which the throughput estimate is measured again by timing a
+# segment download before playback, unless segments went through the HLS proxy
+THROUGHPUT_MAX_AGE = 86400
+# upper bound in seconds for reusing a subscriptions response, also capped by cookie expiry
+SUBSCRIPTION_TTL = 21600
+# services we can list by a marker in their sku, for subscriptions that don't
+# match any of the leagues in the response
+SERVICE_SKUS = (
+    ('NCAA', 'NCAA College Pass', 'ncaa'),
+    ('INDY', 'IndyCar Series', 'indycar'),
+    ('SELECT', 'ESPN Select', 'select')
+)
+
+
+def shift_month(year, month, offset):
+    """Return the (year, month) tuple offset months away from year/month."""
+    index = year * 12 + (month - 1) + offset
+    return index // 12, index % 12 + 1
+
+
+def read_json(path):
+    """Return the decoded contents of a JSON file or None if it can't be read."""
+    try:
+        with open(path, 'rb') as json_file:
+            return json.load(json_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_file(path, data, mode=0o644):
+    """Atomically replace the contents of path with data. Return whether it was
+    written. The temporary file is uniquely named, so that processes writing
+    the same file don't clobber each other's writes, and on POSIX it replaces
+    path in a single rename, so readers never find path missing."""
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.',
+                                        suffix='.tmp')
+    except (IOError, OSError):
+        return False
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.chmod(tmp_path, mode)  # mkstemp only lets the owner read it
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)  # os.rename won't overwrite on Windows
+        os.rename(tmp_path, path)
+        return True
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+
+
+def write_json(path, data):
+    """Atomically write data as JSON to path."""
+    write_file(path, json.dumps(data))
+
+
+def iter_xml(data, tags, stop_tag=None):
+    """Yield the elements named in tags from an XML document as soon as each
+    one is complete, with namespaces stripped from all tag names. Parsing
+    stops after the end of stop_tag, or at the first malformed part."""
+    try:
+        for _, element in ElementTree.iterparse(StringIO(data)):
+            if '}' in element.tag:
+                element.tag = element.tag.split('}', 1)[1]
+            if element.tag in tags:
+                yield element
+            if element.tag == stop_tag:
+                return
+    except SyntaxError:
+        return
+
+
+def parse_subscription_skus(data):
+    """Return the skus in an /account/subscriptions response."""
+    return [element.text.strip() for element in iter_xml(data, ('sku',), stop_tag='subs') if element.text]
+
+
+def parse_subscriptions(data):
+    """Return a (subscriptions, leagues) tuple from an /account/subscriptions
+    response: a set of the upper-cased values (sku, type, ...) of each
+    subscription, and the (type, name) tuples of the leagues it lists."""
+    subscriptions = []
+    leagues = []
+    for element in iter_xml(data, ('sub', 'league')):
+        if element.tag == 'sub':
+            subscriptions.append(set(text.strip().upper() for text in element.itertext() if text.strip()))
+        else:
+            league_type, name = element.findtext('type'), element.findtext('name')
+            if league_type and name:
+                leagues.append((league_type.strip(), name.strip()))
+        element.clear()
+    return subscriptions, leagues
+
+
+def parse_channels(data):
+    """Return a dict mapping channel names to seoNames from a /channels response."""
+    channels = {}
+    for element in iter_xml(data, ('channel',)):
+        channels[element.findtext('name')] = element.findtext('seoName')
+        element.clear()
+    return channels
+
+
+def parse_media_item(data):
+    """Return the child texts of the first user-verified-media-item in a
+    startSession response (url, hls-backup-url, alt-url, ...), or None."""
+    for element in iter_xml(data, ('user-verified-media-item',), stop_tag='user-verified-media-item'):
+        return dict((child.tag, child.text) for child in element)
+    return None
+
+
+EPOCH = datetime(1970, 1, 1)
+# UTC offsets only change on quarter-hour boundaries, so one lookup per bucket is exact
+UTC_OFFSET_BUCKET = 900
+_utc_offsets = {}
+
+
+def utc_to_local(utc_dt):
+    """Convert UTC time to local time."""
+    delta = utc_dt - EPOCH
+    bucket = (delta.days * 86400 + delta.seconds) // UTC_OFFSET_BUCKET * UTC_OFFSET_BUCKET
+    try:
+        offset = _utc_offsets[bucket]
+    except KeyError:
+        offset = datetime.fromtimestamp(bucket) - datetime.utcfromtimestamp(bucket)
+        _utc_offsets[bucket] = offset
+    return utc_dt + offset
+
+
+def parse_datetime(game_date, localize=False):
+    """Parse ESPN Player date string to datetime object."""
+    # fixed layout: YYYY-MM-DDTHH:MM:SS.000
+    if len(game_date) == 23 and game_date[4] == '-' and game_date[10] == 'T' and game_date[19:] == '.000':
+        datetime_obj = datetime(int(game_date[0:4]), int(game_date[5:7]), int(game_date[8:10]),
+                                int(game_date[11:13]), int(game_date[14:16]), int(game_date[17:19]))
+    else:
+        date_time_format = '%Y-%m-%dT%H:%M:%S.000'
+        datetime_obj = datetime(*(time.strptime(game_date, date_time_format)[0:6]))
+    if localize:
+        datetime_obj = utc_to_local(datetime_obj)
+    return datetime_obj
+
+
+class Game(object):
+    """A compact schedule entry holding only what's needed to list and play a game."""
+    __slots__ = ('stats_id', 'name', 'sport_id', 'state', 'home_team', 'away_team', 'image', 'start',
+                 'programs')
+    team_pattern = re.compile(r'(.+)( vs. )(.+)( \()')
+
+    def __init__(self, stats_id, name, sport_id, state, home_team, away_team, image, start, programs):
+        self.stats_id = stats_id
+        self.name = name
+        self.sport_id = sport_id
+        self.state = state
+        self.home_team = home_team
+        self.away_team = away_team
+        self.image = image
+        self.start = start  # local datetime
+        self.programs = programs  # JSON of availablePrograms, None if the game can't be played
+
+    @property
+    def playable(self):
+        return self.programs is not None
+
+    @property
+    def fingerprint(self):
+        """Return a value that changes whenever the game's listing does. Its
+        first item is the gameState."""
+        return self.state, self.programs, self.name, self.start, self.image
+
+    @classmethod
+    def from_json(cls, game):
+        """Build a Game from a game dict in a /schedule response."""
+        try:
+            home_team = game['homeTeam']['name']
+            away_team = game['awayTeam']['name']
+        except (KeyError, TypeError):
+            # try to extract team names from full title
+            teampattern = cls.team_pattern.search(game['name'])
+            if teampattern:
+                home_team = teampattern.group(3)
+                away_team = teampattern.group(1)
+            else:
+                home_team = away_team = None
+        if 'availablePrograms' in game:
+            programs = json.dumps(game['availablePrograms'], sort_keys=True)
+        else:
+            programs = None
+        image = game.get('image')
+        if image:
+            image = image.split('.jpg')[0] + '.jpg'
+        return cls(game['statsId'], game['name'], game.get('sportId'), game['gameState'], home_team, away_team,
+                   image, parse_datetime(game['dateTimeGMT'], localize=True), programs)
+
+    def to_list(self):
+        """Return the game as a compact JSON serialisable list."""
+        return [self.stats_id, self.name, self.sport_id, self.state, self.home_team, self.away_team, self.image,
+                self.start.timetuple()[0:6], self.programs]
+
+    @classmethod
+    def from_list(cls, fields):
+        """Rebuild a Game from the output of to_list() without reparsing its date."""
+        fields = list(fields)
+        fields[7] = datetime(*fields[7])
+        return cls(*fields)
+
+
+class ScheduleIndex(object):
+    """Lookup tables over a list of Game records, built once per schedule payload.
+    Games are indexed by their local date (as a 'YYYY-MM-DD' string) and by
+    their gameState. stale_months lists the (year, month) tuples that were
+    served from an expired cache."""
+
+    def __init__(self, games, stale_months=None):
+        self.games = games
+        self.stale_months = stale_months or []
+        self.by_date = {}
+        self.by_state = {}
+        self._dates = {}
+        for game in games:
+            local_date = game.start.date()
+            key = str(local_date)
+            if key not in self.by_date:
+                self.by_date[key] = []
+                self._dates[key] = local_date
+            self.by_date[key].append(game)
+            self.by_state.setdefault(game.state, []).append(game)
+
+    @classmethod
+    def from_payload(cls, games):
+        """Build an index from the game dicts of a /schedule response."""
+        return cls([Game.from_json(game) for game in games])
+
+    def ttl(self):
+        """Return the seconds a cached copy of this schedule stays fresh, by the state of its games."""
+        if self.by_state:
+            return min(SCHEDULE_TTL.get(state, SCHEDULE_TTL_EMPTY) for state in self.by_state)
+        return SCHEDULE_TTL_EMPTY
+
+    def fingerprints(self):
+        """Return a dict mapping each game's statsId to its fingerprint."""
+        return dict((game.stats_id, game.fingerprint) for game in self.games)
+
+    def to_dict(self):
+        """Return a compact JSON serialisable representation of the index."""
+        return {'games': [game.to_list() for game in self.games]}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild an index from the output of to_dict()."""
+        return cls([Game.from_list(fields) for fields in data['games']])
+
+    @classmethod
+    def merge(cls, indexes):
+        """Return a single index covering the games of all indexes."""
+        games = []
+        stale_months = []
+        for index in indexes:
+            games += index.games
+            stale_months += index.stale_months
+        return cls(games, stale_months)
+
+    def dates(self):
+        """Return a sorted list of the local dates containing at least one game."""
+        return sorted(self._dates.values())
+
+    def find(self, date=None, state=None):
+        """Return the games on a local date and/or with a gameState, in schedule order."""
+        if date is not None:
+            games = self.by_date.get(str(date), [])
+            if state is not None:
+                games = [game for game in games if game.state == state]
+            return games
+        if state is not None:
+            return self.by_state.get(state, [])
+        return self.games
+
+    def query(self, date=None, state=None, sport_id=None, start_date=None, end_date=None, offset=0, limit=None):
+        """Return a (games, total) tuple: at most limit games starting at offset
+        out of the total games matching every given filter, in schedule order.
+        start_date and end_date (inclusive) select a range of local dates."""
+        if start_date is not None or end_date is not None:
+            games = []
+            for local_date in self.dates():
+                if (start_date is None or local_date >= start_date) and (end_date is None or local_date <= end_date):
+                    games += self.by_date[str(local_date)]
+            if date is not None:
+                games = [game for game in games if str(game.start.date()) == str(date)]
+            if state is not None:
+                games = [game for game in games if game.state == state]
+        else:
+            games = self.find(date, state)
+        if sport_id is not None:
+            games = [game for game in games if str(game.sport_id) == str(sport_id)]
+        if limit is None:
+            return games[offset:], len(games)
+        return games[offset:offset + limit], len(games)
+
+
+class Future(object):
+    """The eventual result of a call submitted to ThreadedExecutor or run_in_background()."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        """Wait for the call to finish. Return its result or re-raise its exception."""
+        self._done.wait()
+        if self._exc_info:
+            exc_type, exc_value, exc_traceback = self._exc_info
+            raise exc_type, exc_value, exc_traceback
+        return self._result
+
+
+def first_result(calls, delays=None, accept=None):
+    """Run calls (functions taking no arguments) in background threads and
+    return the first result accepted by accept (default: any result) without
+    waiting for the others. Call i starts delays[i] seconds in, if an earlier
+    call is still running then; a call that fails is never retried by starting
+    the next one early. When no result is accepted, the last exception is
+    re-raised, or else the last result returned."""
+    delays = delays or [0] * len(calls)
+    results = Queue.Queue()
+    started = time.time()
+    next_call = 0
+    running = 0
+    outcome = None
+
+    def run(call):
+        try:
+            results.put((True, call()))
+        except Exception:
+            results.put((False, sys.exc_info()))
+
+    while next_call < len(calls) or running:
+        if next_call and not running:
+            break  # every call so far has finished without an accepted result
+        if next_call < len(calls) and time.time() >= started + delays[next_call]:
+            thread = threading.Thread(target=run, args=(calls[next_call],))
+            thread.daemon = True  # a losing call mustn't keep the process alive
+            thread.start()
+            next_call += 1
+            running += 1
+            continue
+        timeout = max(0, started + delays[next_call] - time.time()) if next_call < len(calls) else None
+        try:
+            result = results.get(timeout=timeout)
+        except Queue.Empty:
+            continue
+        running -= 1
+        if result[0] and (accept is None or accept(result[1])):
+            return result[1]
+        if outcome is None or outcome[0] or not result[0]:
+            outcome = result
+    if not outcome[0]:
+        exc_type, exc_value, exc_traceback = outcome[1]
+        raise exc_type, exc_value, exc_traceback
+    return outcome[1]
+
+
+class JitteredRetry(Retry):
+    """A Retry whose back-off is randomised, so that clients retrying after
+    the same failure don't hit the server again at the same moment."""
+    jitter = RETRY_JITTER
+
+    def get_backoff_time(self):
+        backoff = Retry.get_backoff_time(self)
+        return backoff * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class ThreadedExecutor(object):
+    """A small bounded thread pool. Any object with compatible map() and submit()
+    methods, such as concurrent.futures.ThreadPoolExecutor, can be used in its
+    place. As with ThreadPoolExecutor, a call running on the executor must not
+    map or submit on the same executor again: once every worker waits for
+    queued work, nothing is left to run it. Use run_in_background() to start
+    work that maps on the executor itself."""
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self._queue = Queue.Queue()
+        self._workers = 0
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def _worker(self):
+        while True:
+            future, func, args, kwargs = self._queue.get()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+            del future, func, args, kwargs  # don't keep the last call's client alive while idle
+            with self._lock:
+                self._idle += 1
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) to run on one of at most max_workers
+        threads, which are started on demand. Return a Future."""
+        future = Future()
+        with self._lock:
+            if self._idle:
+                self._idle -= 1
+            elif self._workers < self.max_workers:
+                self._workers += 1
+                thread = threading.Thread(target=self._worker)
+                thread.daemon = True  # idle workers mustn't keep the process alive
+                thread.start()
+            self._queue.put((future, func, args, kwargs))
+        return future
+
+    def map(self, func, iterable):
+        """Return [func(item) for item in iterable], evaluated concurrently.
+        The first exception raised by a call is re-raised in the caller."""
+        items = list(iterable)
+        if len(items) < 2 or self.max_workers < 2:
+            return [func(item) for item in items]
+        return [future.result() for future in [self.submit(func, item) for item in items]]
+
+
+def run_in_background(func, *args, **kwargs):
+    """Run func(*args, **kwargs) in a new background thread. Return a Future."""
+    future = Future()
+
+    def worker():
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    return future
+
+
+class ThroughputEstimator(object):
+    """An exponentially weighted estimate of download throughput in bits per
+    second, kept in a JSON history file between plugin invocations. Small
+    downloads are dominated by latency, so a sample's weight grows with its
+    size up to reference_bytes, and only a download of at least seed_bytes
+    (such as a media segment, not a playlist) can start the estimate."""
+    # bumped whenever estimates kept in the history file can no longer be trusted
+    history_version = 2
+
+    def __init__(self, history_file=None, alpha=0.3, reference_bytes=512 * 1024, seed_bytes=128 * 1024):
+        self.history_file = history_file
+        self.alpha = alpha
+        self.reference_bytes = reference_bytes
+        self.seed_bytes = seed_bytes
+        self._lock = threading.Lock()
+        history = read_json(history_file) if history_file else None
+        if not history or history.get('version') != self.history_version:
+            history = None
+        self.estimate = history['estimate'] if history else None
+        self.samples = history['samples'] if history else 0
+        # when a download of at least seed_bytes was last measured
+        self.measured = history.get('measured', 0) if history else 0
+
+    def add_sample(self, num_bytes, seconds):
+        """Fold a download of num_bytes that took seconds into the estimate."""
+        if num_bytes <= 0 or seconds <= 0:
+            return
+        sample = num_bytes * 8 / seconds
+        with self._lock:
+            if self.estimate is None:
+                if num_bytes < self.seed_bytes:
+                    return
+                self.estimate = sample
+            else:
+                weight = self.alpha * min(1.0, float(num_bytes) / self.reference_bytes)
+                self.estimate = weight * sample + (1 - weight) * self.estimate
+            self.samples += 1
+            if num_bytes >= self.seed_bytes:
+                self.measured = time.time()
+
+    def recent(self, max_age=THROUGHPUT_MAX_AGE):
+        """Return whether the estimate rests on a download of at least
+        seed_bytes measured within max_age seconds."""
+        return self.estimate is not None and self.measured > time.time() - max_age
+
+    def save(self):
+        if self.history_file and self.estimate is not None:
+            with self._lock:
+                write_json(self.history_file, {'version': self.history_version, 'estimate': self.estimate,
+                                               'samples': self.samples, 'measured': self.measured,
+                                               'updated': time.time()})
+
+    def select_variant(self, variants, headroom=0.8):
+        """Return the highest variant whose bandwidth fits within headroom of the
+        estimate (the lowest one if none fits), or None until a download large
+        enough to seed the estimate has been measured.
+        variants are expected to be ordered by bandwidth, highest first."""
+        if self.estimate is None or not variants:
+            return None
+        budget = self.estimate * headroom
+        for variant in variants:
+            if variant['bandwidth'] <= budget:
+                return variant
+        return variants[-1]
+
+
+class CookieStore(cookielib.LWPCookieJar):
+    """An LWPCookieJar that tracks whether its cookies changed. Saves requested
+    through request_save() are deferred until flush(), which writes the file
+    atomically and only when something actually changed."""
+
+    def __init__(self, filename):
+        cookielib.LWPCookieJar.__init__(self, filename)
+        self.dirty = False
+        self.save_requests = 0
+        self.writes = 0
+        self._flush_lock = threading.Lock()
+
+    @property
+    def writes_avoided(self):
+        """Return how many of the writes made before batching (one per
+        request_save(), i.e. per response) weren't needed."""
+        return self.save_requests - self.writes
+
+    # a Max-Age cookie re-sent by the server only moves its expiry by a few seconds
+    expiry_tolerance = 300
+
+    def _changed(self, old, new):
+        if (old.value, old.secure, old.discard) != (new.value, new.secure, new.discard):
+            return True
+        if old.expires is None or new.expires is None:
+            return old.expires != new.expires
+        return abs(new.expires - old.expires) > self.expiry_tolerance
+
+    def set_cookie(self, cookie):
+        existing = self._cookies.get(cookie.domain, {}).get(cookie.path, {}).get(cookie.name)
+        if existing is None or self._changed(existing, cookie):
+            self.dirty = True
+        cookielib.LWPCookieJar.set_cookie(self, cookie)
+
+    def clear(self, domain=None, path=None, name=None):
+        cookielib.LWPCookieJar.clear(self, domain, path, name)
+        self.dirty = True
+
+    def load(self, filename=None, ignore_discard=False, ignore_expires=False):
+        cookielib.LWPCookieJar.load(self, filename, ignore_discard, ignore_expires)
+        self.dirty = False
+
+    def reload(self):
+        """Replace the cookies with the contents of the cookie file, which
+        another process may have written since it was loaded."""
+        with self._flush_lock:
+            cookielib.LWPCookieJar.clear(self)
+            try:
+                self.load(ignore_discard=True, ignore_expires=True)
+            except IOError:
+                pass
+            self.dirty = False
+
+    def request_save(self):
+        """Record that the jar may need to be persisted. The write happens in flush()."""
+        self.save_requests += 1
+
+    def flush(self):
+        """Write the cookie file if any cookie changed since the last write."""
+        with self._flush_lock:
+            if not self.dirty:
+                return False
+            self.dirty = False
+            # the plugin and the service both write the cookie file
+            data = '#LWP-Cookies-2.0\n' + self.as_lwp_str(ignore_discard=True, ignore_expires=False)
+            if not write_file(self.filename, data, mode=0o600):
+                self.dirty = True
+                return False
+            self.writes += 1
+            return True
+
+
+def batch_cookie_writes(method):
+    """Decorate an espnlib operation so that the cookie jar is flushed once,
+    when the outermost decorated call returns."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.operation_lock:
+            self.operation_depth += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            with self.operation_lock:
+                self.operation_depth -= 1
+                outermost = self.operation_depth == 0
+            if outermost:
+                self.flush_cookies()
+    return wrapper
 
 
 class espnlib(object):
-    def __init__(self, cookie_file, debug=False, verify_ssl=True):
+    def __init__(self, cookie_file, debug=False, verify_ssl=True, cache_dir=None, executor=None,
+                 schedule_window=(-1, 0), instrumentation=None, pool_connections=4, pool_maxsize=None,
+                 retries=2, timeout=DEFAULT_TIMEOUT, base_url=None, neulion_url=None, endpoint_timeouts=None,
+                 hedge_delays=None):
         self.debug = debug
+        self.instrumentation = instrumentation or Instrumentation()
         self.verify_ssl = verify_ssl
-        self.base_url = 'https://www.espnplayer.com'
+        self.cache_dir = cache_dir
+        self.executor = executor or ThreadedExecutor()
+        # first and last month offset (inclusive) relative to the current month
+        self.schedule_window = schedule_window
+        self.refresh_interval = REFRESH_INPLAY
+        self.base_url = base_url or BASE_URL
+        self.neulion_url = neulion_url or NEULION_URL
+        self.timeout = timeout
+        self.endpoint_timeouts = ENDPOINT_TIMEOUTS if endpoint_timeouts is None else endpoint_timeouts
+        self.hedge_delays = HEDGE_DELAYS if hedge_delays is None else hedge_delays
         self.http_session = requests.Session()
-        self.cookie_jar = cookielib.LWPCookieJar(cookie_file)
+        if pool_maxsize is None:
+            # let every concurrent worker keep its own pooled connection per host
+            pool_maxsize = max(getattr(self.executor, 'max_workers', None) or 0, requests.adapters.DEFAULT_POOLSIZE)
+        # one adapter (and thereby one set of keep-alive pools) per host we talk to; the
+        # scheme-wide adapters cover the manifest and segment CDNs
+        for prefix in (self.base_url, self.neulion_url, 'https://', 'http://'):
+            retry = JitteredRetry(total=retries, connect=retries, read=retries, redirect=0,
+                                  backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUSES)
+            self.http_session.mount(prefix, InstrumentedAdapter(pool_connections=pool_connections,
+                                                                pool_maxsize=pool_maxsize, max_retries=retry))
+        self.operation_lock = threading.Lock()
+        self.operation_depth = 0
+        self.token_file = cookie_file + '.tokens'
+        self.token_lock = threading.Lock()
+        self.subscription_file = cookie_file + '.subscriptions'
+        self.stream_file = cookie_file + '.streams'
+        # the measured throughput belongs to this installation, so it isn't kept in a shared cache_dir
+        self.throughput = ThroughputEstimator(cookie_file + '.throughput')
+        self.stream_lock = threading.Lock()
+        self.cookie_jar = CookieStore(cookie_file)
         try:
             self.cookie_jar.load(ignore_discard=True, ignore_expires=True)
         except IOError:
@@ -36,6 +742,13 @@ class espnlib(object):
         def __str__(self):
             return repr(self.value)
 
+    def flush_cookies(self):
+        """Persist the cookie jar if it changed. Return whether it was written."""
+        written = self.cookie_jar.flush()
+        self.log('Cookie jar %s (%d writes avoided).' % ('saved' if written else 'unchanged',
+                                                         self.cookie_jar.writes_avoided))
+        return written
+
     def log(self, string):
         if self.debug:
             try:
@@ -48,34 +761,84 @@ class espnlib(object):
             except:
                 pass
 
-    def make_request(self, url, method, payload=None, headers=None, return_req=False):
-        """Make an HTTP request. Return the response."""
-        self.log('Request URL: %s' % url)
+    def is_api_url(self, url):
+        """Return whether url points at ESPN Player or Neulion rather than a CDN."""
+        return url.startswith(self.base_url + '/') or url.startswith(self.neulion_url + '/')
+
+    def send_request(self, url, method, payload=None, headers=None, stream=False, allow_redirects=False):
+        """Send a single request within the endpoint's latency budget and record
+        it. Return a (response, instrumentation record) tuple."""
+        req = None
+        timeout = self.endpoint_timeouts.get(urlparse(url).path, self.timeout)
+        self.instrumentation.start_request()
         try:
             if method == 'get':
-                req = self.http_session.get(url, params=payload, headers=headers, allow_redirects=False,
-                                            verify=self.verify_ssl)
+                req = self.http_session.get(url, params=payload, headers=headers, allow_redirects=allow_redirects,
+                                            verify=self.verify_ssl, stream=stream, timeout=timeout)
             else:  # post
-                req = self.http_session.post(url, data=payload, headers=headers, allow_redirects=False,
-                                             verify=self.verify_ssl)
-            req.raise_for_status()
+                req = self.http_session.post(url, data=payload, headers=headers, allow_redirects=allow_redirects,
+                                             verify=self.verify_ssl, stream=stream, timeout=timeout)
+            if not stream:
+                req.content  # read the body so it's part of the timing
+        except requests.exceptions.RequestException:
+            self.instrumentation.finish_request(method, url, req)
+            raise
+        return req, self.instrumentation.finish_request(method, url, req, None if stream else len(req.content))
+
+    def make_request(self, url, method, payload=None, headers=None, return_req=False, stream=False,
+                     allow_redirects=False):
+        """Make an HTTP request. Return the response. A streamed response is
+        always returned as the response object and its body isn't logged.
+        GETs to endpoints in hedge_delays are sent a second time when they're
+        still unanswered after the endpoint's delay; the first response wins."""
+        self.log('Request URL: %s' % url)
+        try:
+            hedge_delay = self.hedge_delays.get(urlparse(url).path)
+            if method == 'get' and not stream and hedge_delay is not None:
+                def send(hedged):
+                    req, record = self.send_request(url, method, payload, headers, stream, allow_redirects)
+                    record['hedged'] = hedged
+                    return req, record
+
+                req, record = first_result([lambda: send(False), lambda: send(True)], delays=[0, hedge_delay])
+                self.instrumentation.use_record(record)
+            else:
+                req = self.send_request(url, method, payload, headers, stream, allow_redirects)[0]
+            try:
+                req.raise_for_status()
+            except requests.exceptions.HTTPError:
+                if stream:
+                    req.close()  # the caller never gets the response, so release its connection here
+                raise
             self.log('Response code: %s' % req.status_code)
-            self.log('Response: %s' % req.content)
-            self.cookie_jar.save(ignore_discard=True, ignore_expires=False)
+            if stream:
+                self.cookie_jar.request_save()
+                return req
+            if len(req.content) > LOG_BODY_LIMIT:
+                self.log('Response (%d bytes): %s...' % (len(req.content), req.content[:LOG_BODY_LIMIT]))
+            else:
+                self.log('Response: %s' % req.content)
+            self.cookie_jar.request_save()
             if return_req:
                 return req
             else:
                 return req.content
         except requests.exceptions.HTTPError as error:
             self.log('An HTTP error occurred: %s' % error)
+            if (error.response is not None and error.response.status_code in (401, 403)
+                    and self.is_api_url(error.response.url)):
+                # stored subscription state can't be trusted once ESPN Player or Neulion
+                # reject us; CDN 403s only mean that a playback session expired
+                self.invalidate_subscriptions()
             raise
         except requests.exceptions.ConnectionError as error:
             self.log('Connection Error: - %s' % error.message)
             raise
         except requests.exceptions.RequestException as error:
-            self.log('Error: - %s' % error.value)
+            self.log('Error: - %s' % error)
             raise
 
+    @batch_cookie_writes
     def login(self, username=None, password=None):
         """Complete login process for ESPN Player. Errors (auth issues, blackout,
         etc) are raised as LoginFailure.
@@ -86,7 +849,7 @@ class espnlib(object):
             if username and password:
                 self.log('Not (yet) logged into ESPN Player.')
                 self.login_to_account(username, password)
-                if not self.check_for_subscription():
+                if not self.check_for_subscription(force_refresh=True):
                     raise self.LoginFailure('Login failed')
 
             else:
@@ -96,115 +859,350 @@ class espnlib(object):
     def login_to_account(self, username, password):
         """authenticate to ESPN Player.
         """
-        url = 'https://www.espnplayer.com/secure/authenticate'
+        url = self.base_url + '/secure/authenticate'
         post_data = {
             'username': username,
             'password': password,
             'format': 'xml'
         }
+        self.invalidate_subscriptions()
         sc_data = self.make_request(url=url, method='post', payload=post_data)
         if 'loginsuccess' not in sc_data:
              raise self.LoginFailure('Login failed')
 
-    def check_for_subscription(self):
-        """Return whether a subscription is detected.
+    def get_subscriptions(self, force_refresh=False):
+        """Return the raw /account/subscriptions response. A response with a
+        subscription is stored next to the cookie jar and reused until the
+        first of its session cookies expires (at most SUBSCRIPTION_TTL seconds).
         """
-        url = "https://www.espnplayer.com/account/subscriptions"
+        if not force_refresh:
+            stored = read_json(self.subscription_file)
+            if stored and stored['expires'] > time.time():
+                self.log('Using stored subscriptions response.')
+                return stored['data'].encode('utf-8')
+
+        url = self.base_url + '/account/subscriptions'
         post_data = {'isFlex': 'true','format': 'xml'}
         sc_data = self.make_request(url=url, method='post', payload=post_data)
-        sc_dict = xmltodict.parse(sc_data)
-#        self.log(sc_dict)
-#        if sc_dict['isBlocked'] == 'true':
-#            self.log('ESPN Player is geo blocked.')
-#            return False
-        if 'sku' not in sc_data:
+        if self.instrumentation.parse(parse_subscription_skus, sc_data):
+            now = time.time()
+            expires = now + SUBSCRIPTION_TTL
+            cookie_expiry = [cookie.expires for cookie in self.cookie_jar
+                             if cookie.expires and 'espnplayer.com' in cookie.domain]
+            if cookie_expiry:
+                expires = min([expires] + cookie_expiry)
+            if expires > now:
+                write_json(self.subscription_file, {'expires': expires, 'data': sc_data.decode('utf-8')})
+        else:
+            self.invalidate_subscriptions()
+        return sc_data
+
+    def invalidate_subscriptions(self):
+        """Forget the stored subscriptions response."""
+        try:
+            os.remove(self.subscription_file)
+        except OSError:
+            pass
+
+    def check_for_subscription(self, force_refresh=False):
+        """Return whether a subscription is detected.
+        """
+        if not parse_subscription_skus(self.get_subscriptions(force_refresh)):
             self.log('No subscription detected in ESPN Player response.')
             return False
         else:
             self.log('Subscription detected in ESPN Player response.')
             return True
 
+    @batch_cookie_writes
     def get_services(self):
-        """Return a dict of the services the user is subscribed to."""
+        """Return a dict of the services the user is subscribed to: for each
+        subscription, the leagues whose type is one of its values, or failing
+        that, the SERVICE_SKUS whose marker appears in one of its values."""
+        subscriptions, leagues = parse_subscriptions(self.get_subscriptions())
         services = {}
-        subscribed_services = []
-        url = 'https://www.espnplayer.com/account/subscriptions'
-        post_data = {'format': 'xml','isFlex': 'true'}
-        sc_data = self.make_request(url=url, method='post', payload=post_data)
-        sc_dict = xmltodict.parse(sc_data)['subscriptions']
-        if 'NCAA' in sc_data:
-            services.update({'NCAA College Pass': 'ncaa'})
-        
-        if 'INDY' in sc_data:
-            services.update({'IndyCar Series': 'indycar'})
-  
-        if 'SELECT' in sc_data:
-            services.update({'ESPN Select': 'select'})
-
-#        for service in sc_dict['subs'].values():
-#            subscribed_services.append(service)
-
-#        for service in sc_dict['leagues']['league']:
-#            if service['type'] in subscribed_services:
-#                services[service['name']] = service['type']
-        
+        for subscription in subscriptions:
+            matched = dict((name, league_type) for league_type, name in leagues
+                           if league_type.upper() in subscription)
+            if not matched:
+                matched = dict((name, service) for marker, name, service in SERVICE_SKUS
+                               if any(marker in value for value in subscription))
+            services.update(matched)
         return services
 
-    def get_games(self, service, filter_date=False, filter_games=False, category='all'):
-        """Return games in a list. Ability to sort games by date/game status."""
-        url = 'https://www.espnplayer.com/schedule'
-        filter_mask = { 0: 'upcoming',
-                        1: 'inplay',
-                        3: 'archive' 
+    def schedule_cache_file(self, service, year, month):
+        """Return the path of a schedule month's cache file, or None without a cache directory."""
+        if self.cache_dir:
+            return os.path.join(self.cache_dir, 'schedule_%s_%d-%02d.json' % (service, year, month))
+        return None
+
+    def read_schedule_cache(self, service, year, month):
+        """Return the cached data of a schedule month regardless of its age, or None."""
+        cache_file = self.schedule_cache_file(service, year, month)
+        cached = read_json(cache_file) if cache_file else None
+        if cached and cached.get('version') == SCHEDULE_CACHE_VERSION:
+            return cached
+        return None
+
+    def get_schedule_month(self, service, year, month, allow_stale=False):
+        """Return a ScheduleIndex for one schedule month, served from the cache
+        while it's fresh. With allow_stale, an expired cached month is returned
+        as is and marked stale instead."""
+        cached = self.read_schedule_cache(service, year, month)
+        if cached and cached['expires'] > time.time():
+            self.log('Using cached schedule for %s %d-%02d.' % (service, year, month))
+            return ScheduleIndex.from_dict(cached)
+        if cached and allow_stale:
+            self.log('Using stale schedule for %s %d-%02d.' % (service, year, month))
+            index = ScheduleIndex.from_dict(cached)
+            index.stale_months.append((year, month))
+            return index
+        return self.fetch_schedule_month(service, year, month)[0]
+
+    def fetch_schedule_month(self, service, year, month):
+        """Fetch one schedule month and store it in the cache.
+        Return a (ScheduleIndex, response size in bytes) tuple."""
+        url = self.base_url + '/schedule'
+        payload = {
+            # 'product': service,
+            # 'category': category,
+            'lid': service,
+            'format': 'json',
+            'ps': 300,
+            'monthly': '%d-%02d' % (year, month)
         }
-        games = []
+        games_data = self.make_request(url=url, method='get', payload=payload)
+        index = self.instrumentation.parse(lambda: ScheduleIndex.from_payload(json.loads(games_data)['games']))
+
+        cache_file = self.schedule_cache_file(service, year, month)
+        if cache_file:
+            now = time.time()
+            cached = index.to_dict()
+            cached.update({'version': SCHEDULE_CACHE_VERSION, 'fetched': now, 'expires': now + index.ttl(),
+                           'bytes': len(games_data)})
+            write_json(cache_file, cached)
+
+        return index, len(games_data)
+
+    def schedule_months(self):
+        """Return the (year, month) tuples of the schedule window."""
         now = datetime.now()
-        for month in range(-1,1):
-            payload = {
-                # 'product': service,
-                # 'category': category,
-                'lid': service,
-                'format': 'json',
-                'ps': 300,
-                'monthly': "%d-%02d" % (now.year,(now.month+month))
-            }
-            games_data=self.make_request(url=url, method='get', payload=payload)
-            games+=json.loads(games_data)['games']
-
-        if filter_date:
-            dgames = []
-            for game in games:
-                gamedate = self.parse_datetime(game['dateTimeGMT'], localize=True).date()
-                if str(filter_date) == str(gamedate):
-                    dgames.append(game)
-            games = dgames
-
-        if filter_games:
-            fgames = []
-            for game in games:
-                game_status = game['gameState']
-                if filter_games == filter_mask[game_status]:
-                    fgames.append(game)
-            games = fgames
-
-        return games
-    def get_token(self, airingId):
+        first, last = self.schedule_window
+        return [shift_month(now.year, now.month, offset) for offset in range(first, last + 1)]
+
+    @batch_cookie_writes
+    def get_schedule(self, service, allow_stale=False):
+        """Return a ScheduleIndex covering every month of the schedule window.
+        With allow_stale, only months that were never fetched hit the network."""
+        months = self.schedule_months()
+        return ScheduleIndex.merge(self.executor.map(
+            lambda month: self.get_schedule_month(service, *month, allow_stale=allow_stale), months))
+
+    def stale_schedule_months(self, service):
+        """Return the months of the schedule window whose cached copy expired."""
+        now = time.time()
+        stale_months = []
+        for month in self.schedule_months():
+            cached = self.read_schedule_cache(service, *month)
+            if cached and cached['expires'] <= now:
+                stale_months.append(month)
+        return stale_months
+
+    @batch_cookie_writes
+    def revalidate_months(self, service, months):
+        """Refetch schedule months. Return True if any game was added, removed
+        or changed compared to the cached copy."""
+        def revalidate(month):
+            cached = self.read_schedule_cache(service, *month)
+            index = self.fetch_schedule_month(service, *month)[0]
+            return not cached or ScheduleIndex.from_dict(cached).fingerprints() != index.fingerprints()
+
+        changed = any(self.executor.map(revalidate, months))
+        self.log('Revalidated schedule for %s: %s.' % (service, 'changed' if changed else 'unchanged'))
+        return changed
+
+    def revalidate_schedule(self, service):
+        """Refetch the expired months of the schedule window in the background.
+        Return a Future resolving to whether the schedule changed, or None if
+        nothing expired."""
+        stale_months = self.stale_schedule_months(service)
+        if not stale_months:
+            return None
+        return run_in_background(self.revalidate_months, service, stale_months)
+
+    @batch_cookie_writes
+    def sync_schedule(self, service, max_age=SYNC_MAX_AGE, min_ttl=None, days_behind=1, days_ahead=7):
+        """Incrementally sync the schedule window. Months overlapping the live
+        window (today - days_behind to today + days_ahead) are refetched once
+        their stored copy is older than max_age seconds, and with min_ttl, any
+        month whose stored copy expires within min_ttl seconds is refetched as
+        well; all other months are served from stored data. Return a dict with
+        the merged 'schedule', the games 'added', 'removed' and 'changed' (as
+        (statsId, old gameState, new gameState) tuples) since the stored copy,
+        the 'bytes_fetched' and 'bytes_saved' by this sync, and the time the
+        first of the months 'expires' (None without a cache directory)."""
+        today = datetime.now().date()
+        live_months = set()
+        day = today - timedelta(days=days_behind)
+        while day <= today + timedelta(days=days_ahead):
+            live_months.add((day.year, day.month))
+            day += timedelta(days=1)
+        now = time.time()
+
+        def sync_month(month):
+            cached = self.read_schedule_cache(service, *month)
+            expiring = cached and min_ttl is not None and cached['expires'] <= now + min_ttl
+            if cached and not expiring and (month not in live_months or cached['fetched'] > now - max_age):
+                return ScheduleIndex.from_dict(cached), None, 0, cached.get('bytes', 0), cached['expires']
+            previous = ScheduleIndex.from_dict(cached) if cached else None
+            index, size = self.fetch_schedule_month(service, *month)
+            return index, previous, size, 0, time.time() + index.ttl() if self.cache_dir else None
+
+        result = {'added': [], 'removed': [], 'changed': [], 'bytes_fetched': 0, 'bytes_saved': 0,
+                  'expires': None}
+        indexes = []
+        for index, previous, fetched, saved, expires in self.executor.map(sync_month, self.schedule_months()):
+            indexes.append(index)
+            if expires is not None and (result['expires'] is None or expires < result['expires']):
+                result['expires'] = expires
+            result['bytes_fetched'] += fetched
+            result['bytes_saved'] += saved
+            if previous is None:
+                continue
+            old_fingerprints = previous.fingerprints()
+            new_fingerprints = index.fingerprints()
+            for stats_id, fingerprint in new_fingerprints.items():
+                if stats_id not in old_fingerprints:
+                    result['added'].append(stats_id)
+                elif fingerprint != old_fingerprints[stats_id]:
+                    result['changed'].append((stats_id, old_fingerprints[stats_id][0], fingerprint[0]))
+            result['removed'] += [stats_id for stats_id in old_fingerprints if stats_id not in new_fingerprints]
+
+        result['schedule'] = ScheduleIndex.merge(indexes)
+        self.log('Schedule sync for %s: %d added, %d changed, %d removed, %d bytes fetched, %d bytes saved.' % (
+            service, len(result['added']), len(result['changed']), len(result['removed']),
+            result['bytes_fetched'], result['bytes_saved']))
+        return result
+
+    @batch_cookie_writes
+    def refresh_schedules(self, services):
+        """Refetch every cached month of every service that would expire before
+        the next refresh, and sync the months around today. Return the number
+        of seconds to wait before calling this again: REFRESH_INPLAY while games
+        are in play, otherwise an interval that doubles up to REFRESH_IDLE_MAX,
+        but never longer than it takes for the first refreshed month to come
+        within REFRESH_INPLAY seconds of expiring."""
+        interval = self.refresh_interval
+        # one service after the other, as sync_schedule already maps its months on the executor.
+        # Refreshes are scheduled REFRESH_INPLAY seconds before the first month expires, so
+        # months expiring within twice that are due now, allowing for a late wake-up.
+        syncs = [self.sync_schedule(service, max_age=interval, min_ttl=2 * REFRESH_INPLAY)
+                 for service in services]
+
+        if any(sync['schedule'].by_state.get(1) for sync in syncs):
+            self.refresh_interval = REFRESH_INPLAY
+        else:
+            self.refresh_interval = min(REFRESH_IDLE_MAX, max(REFRESH_IDLE_MIN, interval * 2))
+        wait = self.refresh_interval
+        expiry = [sync['expires'] for sync in syncs if sync['expires'] is not None]
+        if expiry:
+            wait = max(REFRESH_INPLAY, min(wait, int(min(expiry) - time.time()) - REFRESH_INPLAY))
+        self.log('Schedules refreshed, next refresh in %d seconds.' % wait)
+        return wait
+
+    @batch_cookie_writes
+    def get_games(self, service, filter_date=False, filter_games=False, category='all', allow_stale=False):
+        """Return games in a list. Ability to sort games by date/game status.
+        With allow_stale, expired cached months are used as is; see revalidate_schedule()."""
+        return self.query_games(service, filter_date, filter_games, allow_stale=allow_stale)[0]
+
+    @batch_cookie_writes
+    def query_games(self, service, filter_date=False, filter_games=False, sport_id=None, start_date=None,
+                    end_date=None, offset=0, limit=None, allow_stale=False):
+        """Return a (games, total) tuple with one page of the games matching
+        the filters; see ScheduleIndex.query()."""
+        filter_mask = {'upcoming': 0,
+                       'inplay': 1,
+                       'archive': 3
+        }
+        schedule = self.get_schedule(service, allow_stale)
+        return schedule.query(date=filter_date or None, state=filter_mask[filter_games] if filter_games else None,
+                              sport_id=sport_id, start_date=start_date, end_date=end_date, offset=offset,
+                              limit=limit)
+
+    @batch_cookie_writes
+    def get_token(self, airingId, use_prefetched=True):
         """Return a token needed to request a pkan"""
-        url = 'https://www.espnplayer.com/secure/espntoken'
+        if use_prefetched:
+            token = self.pop_prefetched_token(airingId)
+            if token:
+                self.log('Using prefetched token for %s.' % airingId)
+                return token
+        url = self.base_url + '/secure/espntoken'
         payload = {
             'airingId': airingId,
             'format': 'json',
             'isFlex': 'true'
         }
         sc_data = self.make_request(url=url, method='post', payload=payload)
-        return json.loads(sc_data)['data']
+        return self.instrumentation.parse(json.loads, sc_data)['data']
+
+    def prefetch_tokens(self, airingIds):
+        """Fetch tokens for airingIds in the background and store them for a
+        short while so that starting playback skips the token round-trip.
+        airingIds with a still fresh stored token are skipped, and nothing is
+        fetched without a stored subscription, i.e. before logging in. Return
+        the background thread, or None if there's nothing to fetch."""
+        subscription = read_json(self.subscription_file)
+        if not subscription or subscription['expires'] <= time.time():
+            self.log('Not logged in, skipping token prefetch.')
+            return None
+        with self.token_lock:
+            stored = read_json(self.token_file) or {}
+        now = time.time()
+        airingIds = [airingId for airingId in airingIds
+                     if str(airingId) not in stored or stored[str(airingId)]['expires'] <= now]
+        if not airingIds:
+            return None
 
+        def prefetch():
+            try:
+                tokens = self.executor.map(lambda airingId: self.get_token(airingId, use_prefetched=False), airingIds)
+            except Exception as error:
+                self.log('Token prefetch failed: %s' % error)
+                return
+            expires = time.time() + TOKEN_TTL
+            with self.token_lock:
+                stored = read_json(self.token_file) or {}
+                for airingId, token in zip(airingIds, tokens):
+                    stored[str(airingId)] = {'expires': expires, 'token': token}
+                write_json(self.token_file, stored)
 
+        thread = threading.Thread(target=prefetch)
+        thread.start()
+        return thread
+
+    def pop_prefetched_token(self, airingId):
+        """Return and forget a fresh prefetched token for airingId, or None."""
+        with self.token_lock:
+            stored = read_json(self.token_file)
+            if not stored:
+                return None
+            now = time.time()
+            entry = stored.pop(str(airingId), None)
+            for key in [key for key, value in stored.items() if value['expires'] <= now]:
+                del stored[key]
+            write_json(self.token_file, stored)
+        if entry and entry['expires'] > now:
+            return entry['token']
+        return None
+
+    @batch_cookie_writes
     def get_pkan(self, token):
         """Return a 'pkan' token needed to request a stream URL.
            Requires a secure token
         """
-        url = 'https://neulion.go.com/espngeo/dgetpkan'
+        url = self.neulion_url + '/espngeo/dgetpkan'
         payload = {
             'airingId': token['airingId'],
             'auth_airingid': token['airingId'],
@@ -216,12 +1214,79 @@ class espnlib(object):
         pkan = self.make_request(url=url, method='post', payload=payload)
         return pkan
 
-    def get_stream_url(self, airingId, channel='espn3'):
-        """Return the URL for a stream. _mediaAuth cookie is needed for decryption."""
+    @batch_cookie_writes
+    def resolve_stream(self, airingId, channel='espn3', username=None, password=None):
+        """Log in and return get_stream_url() for airingId. The subscription check
+        runs concurrently with the token/pkan/startSession chain instead of before it.
+        Login errors are raised as LoginFailure."""
+        login = self.executor.submit(self.login, username, password)
+        try:
+            stream_url = self.get_stream_url(airingId, channel)
+        except (requests.exceptions.HTTPError, KeyError, ValueError) as error:
+            if (isinstance(error, requests.exceptions.HTTPError) and error.response is not None
+                    and not self.is_api_url(error.response.url)):
+                # the manifest CDN failed, which logging in won't change
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                login.result()
+                raise exc_type, exc_value, exc_traceback
+            # the chain may have failed because we weren't logged in yet
+            self.log('Stream resolution failed before login completed: %s' % error)
+            login.result()
+            return self.get_stream_url(airingId, channel)
+        login.result()
+        return stream_url
+
+    def get_cached_stream(self, airingId, channel):
+        """Return the stored manifest and auth cookie of a still valid session, or None."""
+        with self.stream_lock:
+            stored = read_json(self.stream_file)
+        entry = (stored or {}).get('%s/%s' % (airingId, channel))
+        if entry and entry['expires'] > time.time():
+            return entry
+        return None
+
+    def store_stream(self, airingId, channel, manifest, auth_cookie, expires):
+        with self.stream_lock:
+            stored = read_json(self.stream_file) or {}
+            now = time.time()
+            for key in [key for key, value in stored.items() if value['expires'] <= now]:
+                del stored[key]
+            stored['%s/%s' % (airingId, channel)] = {'manifest': manifest, 'auth_cookie': auth_cookie,
+                                                     'expires': expires}
+            write_json(self.stream_file, stored)
+
+    def invalidate_stream(self, airingId, channel):
+        """Forget the stored session of airingId on channel."""
+        with self.stream_lock:
+            stored = read_json(self.stream_file)
+            if stored and stored.pop('%s/%s' % (airingId, channel), None):
+                write_json(self.stream_file, stored)
+
+    @batch_cookie_writes
+    def get_stream_url(self, airingId, channel='espn3', use_cached=True):
+        """Return the URL for a stream. _mediaAuth cookie is needed for decryption.
+        A session started less than SESSION_TTL seconds ago (and whose _mediaAuth
+        cookie hasn't expired) is reused, so only the manifest is requested again.
+        A 403 for its manifest drops it and starts a new session."""
+        if use_cached:
+            cached = self.get_cached_stream(airingId, channel)
+            if cached:
+                self.log('Reusing playback session for %s.' % airingId)
+                try:
+                    bitrates = self.parse_m3u8_manifest(cached['manifest'], auth_cookie=cached['auth_cookie'])
+                    return {'manifest': cached['manifest'], 'auth_cookie': cached['auth_cookie'],
+                            'bitrates': bitrates}
+                except requests.exceptions.HTTPError as error:
+                    if error.response is None or error.response.status_code != 403:
+                        raise
+                    self.log('Stored playback session was rejected, starting a new one.')
+                    self.invalidate_stream(airingId, channel)
+
         stream_url = {}
         auth_cookie = None
+        expires = time.time() + SESSION_TTL
         token = self.get_token(airingId)
-        url = 'https://neulion.go.com/espngeo/startSession'
+        url = self.neulion_url + '/espngeo/startSession'
         payload = {
             'channel': channel,
             'playbackScenario': 'HTTP_CLOUD_WIRED',
@@ -229,7 +1294,7 @@ class espnlib(object):
             'pkan': self.get_pkan(token),
             'pkanType': 'TOKEN',
             'tokenType': 'GATEKEEPER',
-            'ttl': '480',
+            'ttl': str(SESSION_TTL),
             'airingId': airingId,
             'auth_airingid': token['airingId'],
             'auth_timestamp': token['timestamp'],
@@ -239,112 +1304,212 @@ class espnlib(object):
         }
         req = self.make_request(url=url, method='post', payload=payload, return_req=True)
         stream_data = req.content
-        try:
-            stream_dict = xmltodict.parse(stream_data)['user-verified-media-response']['user-verified-event']['user-verified-content']['user-verified-media-item']
-        except KeyError:
+        stream_dict = self.instrumentation.parse(parse_media_item, stream_data)
+        if not stream_dict:
             self.log('Unable to get stream dict.')
-            stream_dict = False
 
         if req.cookies:
             self.log('Cookies: %s' % req.cookies)
             for cookie in req.cookies:
                 if cookie.name == '_mediaAuth':
                     auth_cookie = '%s=%s; path=%s; domain=%s;' % (cookie.name, cookie.value, cookie.path, cookie.domain)
+                    if cookie.expires:
+                        expires = min(expires, cookie.expires)
 
-        if stream_dict:
-            if stream_dict['url']:
-                stream_url['manifest'] = stream_dict['url']
-                self.log('HLS manifest found (primary).')
-            elif stream_dict['hls-backup-url']:
-                stream_url['manifest'] = stream_dict['hls-backup-url']
-                self.log('HLS manifest found (backup).')
-            elif stream_dict['alt-url']:
-                stream_url['manifest'] = stream_dict['alt-url']
-                self.log('HLS manifest found (alternative).')
-            else:
-                stream_url['manifest'] = None
-                self.log('No HLS manifest found.')
+        stream_url['manifest'] = None
+        stream_url['auth_cookie'] = auth_cookie
+        stream_url['bitrates'] = []
+        manifests = [(stream_dict.get(key), kind) for key, kind in MANIFEST_KINDS
+                     if stream_dict and stream_dict.get(key)]
+        if not manifests:
+            self.log('No HLS manifest found.')
+        elif not any(manifest.startswith('http') for manifest, _ in manifests):
+            stream_url['manifest'] = manifests[0][0]
+            self.log('Invalid manifest URL found: %s' % stream_url['manifest'])
+        else:
+            def load(manifest, kind):
+                return lambda: (manifest, kind) + self.download_master_playlist(manifest)
 
-        if stream_url['manifest']:
-            if stream_url['manifest'].startswith('http'):
-                stream_url['bitrates'] = self.parse_m3u8_manifest(stream_url['manifest'], auth_cookie=auth_cookie)
-            else:
-                stream_url['bitrates'] = []
-                self.log('Invalid manifest URL found: %s' % stream_url['manifest'])
+            # race the primary, backup and alternative manifests and use the first with variants;
+            # only the winning download is measured, the others shared its bandwidth
+            manifest, kind, variants, download = first_result(
+                [load(manifest, kind) for manifest, kind in manifests if manifest.startswith('http')],
+                accept=lambda result: result[2])
+            self.log('HLS manifest found (%s).' % kind)
+            bitrates = self.playable_variants(variants, download, auth_cookie)
+            stream_url['manifest'] = manifest
+            stream_url['bitrates'] = bitrates
+            if bitrates:
+                self.store_stream(airingId, channel, manifest, auth_cookie, expires)
 
         return stream_url
 
+    @batch_cookie_writes
     def parse_m3u8_manifest(self, manifest_url, auth_cookie=None):
-        """Return the stream URL along with its bitrate."""
-        streams = {}
-        req = requests.get(manifest_url)
-        m3u8_manifest = req.content
-        self.log('HLS manifest: \n %s' % m3u8_manifest)
+        """Return the variants of a master playlist ordered by bandwidth, highest
+        first. Each variant's play_url carries the cookie header needed for playback."""
+        variants, download = self.download_master_playlist(manifest_url)
+        return self.playable_variants(variants, download, auth_cookie)
 
-        m3u8_header = {'Cookie': auth_cookie}
-        m3u8_obj = m3u8.loads(m3u8_manifest)
+    def download_master_playlist(self, manifest_url):
+        """Return a (variants, (bytes, seconds)) tuple with the variants of a master
+        playlist, ordered by bandwidth, highest first, and the size and duration
+        of its download."""
+        from hls import parse_master_playlist
+        downloaded = []
 
-        for playlist in m3u8_obj.playlists:
-            bitrate = int(playlist.stream_info.bandwidth) / 1000
-            if playlist.uri.startswith('http'):
-                stream_url = playlist.uri
-            else:
-                stream_url = manifest_url[:manifest_url.rfind('/') + 1] + playlist.uri
-            streams[str(bitrate)] = stream_url + '|' + urlencode(m3u8_header)
+        def measured_lines(lines):
+            for line in lines:
+                downloaded.append(len(line) + 1)
+                yield line
+
+        start_time = time.time()
+        req = self.make_request(url=manifest_url, method='get', stream=True, allow_redirects=True)
+        try:
+            variants = self.instrumentation.parse(parse_master_playlist, measured_lines(req.iter_lines()), req.url)
+        finally:
+            req.close()
+        return variants, (sum(downloaded), time.time() - start_time)
+
+    def probe_throughput(self, variant, auth_cookie=None):
+        """Time the download of the first segment of a variant and fold it into
+        the throughput estimate. Without the HLS proxy, this is the only
+        download large enough to measure throughput rather than latency."""
+        headers = {'Cookie': auth_cookie} if auth_cookie else None
+        playlist = self.make_request(url=variant['url'], method='get', headers=headers, return_req=True,
+                                     allow_redirects=True)
+        segments = [line.strip() for line in playlist.content.splitlines()
+                    if line.strip() and not line.startswith('#')]
+        if not segments:
+            return
+        start_time = time.time()
+        req = self.make_request(url=urljoin(playlist.url, segments[0]), method='get', headers=headers, stream=True,
+                                allow_redirects=True)
+        try:
+            num_bytes = len(req.content)
+        finally:
+            req.close()
+        seconds = time.time() - start_time
+        self.throughput.add_sample(num_bytes, seconds)
+        self.throughput.save()
+        self.log('Timed a %d byte segment in %.2f seconds.' % (num_bytes, seconds))
+
+    def playable_variants(self, variants, download, auth_cookie):
+        """Fold the (bytes, seconds) download of the master playlist into the
+        throughput estimate and add each variant's play_url. Return variants."""
+        self.throughput.add_sample(*download)
+        self.throughput.save()
+        self.log('HLS variants: %s' % ', '.join('%d Kbps' % variant['bitrate'] for variant in variants))
+
+        m3u8_header = {'Cookie': auth_cookie}
+        for variant in variants:
+            variant['play_url'] = variant['url'] + '|' + urlencode(m3u8_header)
 
-        return streams
+        return variants
 
+    @batch_cookie_writes
     def get_channels(self, service):
-        """Return a dict with available channels for NCAA College Pass."""
-        channels = {}
-        url = 'https://www.espnplayer.com/channels'
+        """Return a dict with available channels for NCAA College Pass. The list
+        is stored locally and revalidated with ETag/Last-Modified once it's
+        older than CHANNELS_TTL seconds."""
+        cache_file = os.path.join(self.cache_dir, 'channels_%s.json' % service) if self.cache_dir else None
+        cached = read_json(cache_file) if cache_file else None
+        if cached and cached['checked'] > time.time() - CHANNELS_TTL:
+            self.log('Using stored channel list for %s.' % service)
+            return cached['channels']
+
+        url = self.base_url + '/channels'
         payload = {
         #     'product': service
             'lid': service,
             'format': 'xml'
         }
+        headers = {}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
 
-        channel_data = self.make_request(url=url, method='get', payload=payload)
-        channel_dict = xmltodict.parse(channel_data)['result']['channels']['channel']
+        req = self.make_request(url=url, method='get', payload=payload, headers=headers, return_req=True)
+        if req.status_code == 304 and cached:
+            self.log('Stored channel list for %s is still valid.' % service)
+            channels = cached['channels']
+        else:
+            channels = self.instrumentation.parse(parse_channels, req.content)
 
-        for channel in channel_dict:
-            channel_name = channel['name']
-            channel_id = channel['seoName']
-            channels[channel_name] = channel_id
+        if cache_file:
+            write_json(cache_file, {
+                'channels': channels,
+                'etag': req.headers.get('ETag') or (cached or {}).get('etag'),
+                'last_modified': req.headers.get('Last-Modified') or (cached or {}).get('last_modified'),
+                'checked': time.time()
+            })
         return channels
 
+    def channel_art_file(self, channel_id):
+        """Return the local path of a channel's artwork, or None without a cache directory."""
+        if self.cache_dir:
+            return os.path.join(self.cache_dir, 'channel_art', '%s.png' % channel_id)
+        return None
+
+    def get_channel_art(self, channel_id):
+        """Return the local artwork of a channel if it has been downloaded, otherwise its remote URL."""
+        art_file = self.channel_art_file(channel_id)
+        if art_file and os.path.exists(art_file):
+            return art_file
+        return CHANNEL_ART_URL % channel_id
+
+    def prefetch_channel_art(self, channel_ids):
+        """Download missing or outdated channel artwork into the cache directory
+        in one background pass. Return the background thread, or None if
+        there's nothing to download."""
+        if not self.cache_dir:
+            return None
+        art_dir = os.path.join(self.cache_dir, 'channel_art')
+        if not os.path.isdir(art_dir):
+            os.makedirs(art_dir)
+        expired = time.time() - CHANNEL_ART_TTL
+        missing = [channel_id for channel_id in channel_ids
+                   if not os.path.exists(self.channel_art_file(channel_id))
+                   or os.path.getmtime(self.channel_art_file(channel_id)) < expired]
+        if not missing:
+            return None
+
+        def download(channel_id):
+            try:
+                image = self.make_request(url=CHANNEL_ART_URL % channel_id, method='get', allow_redirects=True)
+            except requests.exceptions.RequestException:
+                return
+            if not write_file(self.channel_art_file(channel_id), image):
+                self.log('Unable to store artwork for %s.' % channel_id)
+
+        def prefetch():
+            self.executor.map(download, missing)
+            self.flush_cookies()
+
+        thread = threading.Thread(target=prefetch)
+        thread.start()
+        return thread
+
+    @batch_cookie_writes
     def get_gamedates(self, service, filter=False):
         """Return a list with dates containing at least one game."""
-        dates = []
-        now = datetime.now()
-        games = self.get_games(service)
+        today = datetime.now().date()
+        dates = self.get_schedule(service).dates()
 
-        for game in games:
-            gamedate = self.parse_datetime(game['dateTimeGMT'], localize=True).date()
-            if gamedate not in dates:
-                if filter == 'upcoming':
-                    if gamedate > now.date():
-                        dates.append(gamedate)
-                elif filter == 'archive':
-                    if gamedate < now.date():
-                        dates.append(gamedate)
-                else:
-                    dates.append(gamedate)
+        if filter == 'upcoming':
+            dates = [date for date in dates if date > today]
+        elif filter == 'archive':
+            dates = [date for date in dates if date < today]
 
         return dates
 
     def utc_to_local(self, utc_dt):
         """Convert UTC time to local time."""
-        # get integer timestamp to avoid precision lost
-        timestamp = calendar.timegm(utc_dt.timetuple())
-        local_dt = datetime.fromtimestamp(timestamp)
-        assert utc_dt.resolution >= timedelta(microseconds=1)
-        return local_dt.replace(microsecond=utc_dt.microsecond)
+        return utc_to_local(utc_dt)
 
     def parse_datetime(self, game_date, localize=False):
         """Parse ESPN Player date string to datetime object."""
-        date_time_format = '%Y-%m-%dT%H:%M:%S.000'
-        datetime_obj = datetime(*(time.strptime(game_date, date_time_format)[0:6]))
-        if localize:
-            datetime_obj = self.utc_to_local(datetime_obj)
-        return datetime_obj
+        return parse_datetime(game_date, localize)
+
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight HLS helpers for ESPN Player streams
+"""
+import re
+import time
+import threading
+import Queue
+import BaseHTTPServer
+import SocketServer
+from collections import OrderedDict
+from urllib import urlencode
+from urlparse import urljoin, urlparse, parse_qs
+
+import requests
+
+ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+URI_ATTRIBUTE_PATTERN = re.compile(r'URI="([^"]*)"')
+STREAM_INF_TAG = '#EXT-X-STREAM-INF:'
+
+
+def parse_attribute_list(attribute_list):
+    """Return a dict of the attributes in an HLS tag's attribute list."""
+    attributes = {}
+    for name, value in ATTRIBUTE_PATTERN.findall(attribute_list):
+        if value.startswith('"'):
+            value = value[1:-1]
+        attributes[name] = value
+    return attributes
+
+
+def parse_master_playlist(lines, base_url):
+    """Return the variants of a master playlist ordered by bandwidth, highest
+    first. lines can be any iterable (e.g. a streamed response); only
+    EXT-X-STREAM-INF tags and the URI lines following them are parsed.
+    Variants sharing a bitrate are collapsed into the first one listed."""
+    variants = []
+    bitrates = set()
+    stream_info = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(STREAM_INF_TAG):
+            stream_info = parse_attribute_list(line[len(STREAM_INF_TAG):])
+        elif stream_info is not None and not line.startswith('#'):
+            try:
+                bandwidth = int(stream_info['BANDWIDTH'])
+            except (KeyError, ValueError):
+                stream_info = None
+                continue
+            bitrate = bandwidth // 1000
+            if bitrate not in bitrates:
+                bitrates.add(bitrate)
+                variants.append({
+                    'bandwidth': bandwidth,
+                    'bitrate': bitrate,
+                    'resolution': stream_info.get('RESOLUTION'),
+                    'codecs': stream_info.get('CODECS'),
+                    'url': line if line.startswith('http') else urljoin(base_url, line)
+                })
+            stream_info = None
+
+    variants.sort(key=lambda variant: variant['bandwidth'], reverse=True)
+    return variants
+
+
+class SegmentCache(object):
+    """A bounded, thread-safe ring buffer of downloaded segments keyed by URL."""
+
+    def __init__(self, max_segments):
+        self.max_segments = max_segments
+        self._segments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, url):
+        with self._lock:
+            return url in self._segments
+
+    def get(self, url):
+        with self._lock:
+            return self._segments.get(url)
+
+    def put(self, url, data):
+        with self._lock:
+            self._segments.pop(url, None)
+            self._segments[url] = data
+            while len(self._segments) > self.max_segments:
+                self._segments.popitem(last=False)
+
+
+class ProxyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        url = parse_qs(query).get('u', [None])[0]
+        proxy = self.server.proxy
+        if not url or path not in ('/playlist.m3u8', '/segment'):
+            self.send_error(404)
+            return
+        if not proxy.allows(url):
+            # the auth cookie is only sent to the hosts of the stream being played
+            self.send_error(403)
+            return
+        try:
+            if path == '/playlist.m3u8':
+                body = proxy.get_playlist(url)
+                content_type = 'application/vnd.apple.mpegurl'
+            else:
+                body = proxy.get_segment(url)
+                content_type = 'application/octet-stream'
+        except requests.exceptions.RequestException as error:
+            proxy.log('Upstream request failed: %s' % error)
+            status = getattr(error.response, 'status_code', None) or 502
+            if status == 403 and proxy.on_forbidden:
+                proxy.on_forbidden()
+            self.send_error(status)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HLSProxy(object):
+    """A localhost HLS proxy. Playlists are fetched on demand and rewritten so
+    that every segment and key is requested through the proxy, which sends the
+    auth cookie upstream over the pooled session, prefetches the next segments
+    in parallel and keeps recent ones in a bounded in-memory ring buffer.
+    Only the hosts of playlists passed to proxy_url() and of the URLs found in
+    the playlists it served are proxied."""
+
+    def __init__(self, session, headers=None, prefetch_segments=3, cache_segments=12, verify_ssl=True,
+                 timeout=30, log=None, on_download=None, on_forbidden=None):
+        self.session = session
+        # called with (bytes, seconds) for every upstream segment download
+        self.on_download = on_download
+        # called when the CDN rejects a request, i.e. the playback session is no longer valid
+        self.on_forbidden = on_forbidden
+        self.headers = headers or {}
+        self.prefetch_segments = prefetch_segments
+        self.verify_ssl = verify_ssl
+        self.timeout = timeout
+        self.log = log or (lambda string: None)
+        self.cache = SegmentCache(cache_segments)
+        self.server = None
+        self._hosts = set()
+        self._segments = []
+        self._segment_order = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._prefetch_queue = Queue.Queue()
+
+    def start(self):
+        """Start serving on a free localhost port."""
+        self.server = ProxyServer(('127.0.0.1', 0), ProxyRequestHandler)
+        self.server.proxy = self
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        for _ in range(self.prefetch_segments):
+            worker = threading.Thread(target=self._prefetch_worker)
+            worker.daemon = True
+            worker.start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            for _ in range(self.prefetch_segments):
+                self._prefetch_queue.put(None)
+
+    def allows(self, url):
+        """Return whether url is on a host of the stream being proxied."""
+        parsed = urlparse(url)
+        with self._lock:
+            return parsed.scheme in ('http', 'https') and parsed.netloc in self._hosts
+
+    def proxy_url(self, playlist_url):
+        """Return the local URL serving playlist_url. start() must have been called."""
+        with self._lock:
+            self._hosts.add(urlparse(playlist_url).netloc)
+        return 'http://127.0.0.1:%d/playlist.m3u8?%s' % (self.server.server_address[1],
+                                                        urlencode({'u': playlist_url}))
+
+    def fetch(self, url):
+        """Return the body of an upstream resource."""
+        req = self.session.get(url, headers=self.headers, verify=self.verify_ssl, timeout=self.timeout)
+        req.raise_for_status()
+        return req.content
+
+    def get_playlist(self, url):
+        """Return the upstream playlist rewritten to point at the proxy."""
+        lines = []
+        segments = []
+        hosts = set()
+
+        def rewrite_uri(match):
+            absolute_url = urljoin(url, match.group(1))
+            hosts.add(urlparse(absolute_url).netloc)
+            return 'URI="/segment?%s"' % urlencode({'u': absolute_url})
+
+        for line in self.fetch(url).splitlines():
+            line = line.strip()
+            if line.startswith('#EXT-X-KEY') or line.startswith('#EXT-X-MAP'):
+                line = URI_ATTRIBUTE_PATTERN.sub(rewrite_uri, line)
+            elif line and not line.startswith('#'):
+                absolute_url = urljoin(url, line)
+                hosts.add(urlparse(absolute_url).netloc)
+                if '.m3u8' in line:
+                    line = '/playlist.m3u8?%s' % urlencode({'u': absolute_url})
+                else:
+                    segments.append(absolute_url)
+                    line = '/segment?%s' % urlencode({'u': absolute_url})
+            lines.append(line)
+
+        with self._lock:
+            self._hosts.update(hosts)
+            self._segment_order = dict((segment, index) for index, segment in enumerate(segments))
+            self._segments = segments
+        return '\n'.join(lines) + '\n'
+
+    def get_segment(self, url):
+        """Return a segment (or key) from the ring buffer or upstream, and queue
+        prefetching of the segments following it."""
+        data = self._download(url)
+        with self._lock:
+            index = self._segment_order.get(url)
+            upcoming = self._segments[index + 1:index + 1 + self.prefetch_segments] if index is not None else []
+        for segment in upcoming:
+            if segment not in self.cache:
+                self._prefetch_queue.put(segment)
+        return data
+
+    def _download(self, url):
+        """Download url once, even when it's requested concurrently, and cache it."""
+        data = self.cache.get(url)
+        if data is not None:
+            return data
+        with self._lock:
+            pending = self._pending.get(url)
+            owner = pending is None
+            if owner:
+                pending = self._pending[url] = threading.Event()
+        if not owner:
+            pending.wait(self.timeout)
+            data = self.cache.get(url)
+            if data is not None:
+                return data
+        try:
+            start_time = time.time()
+            data = self.fetch(url)
+            if self.on_download:
+                self.on_download(len(data), time.time() - start_time)
+            self.cache.put(url, data)
+            return data
+        finally:
+            if owner:
+                with self._lock:
+                    del self._pending[url]
+                pending.set()
+
+    def _prefetch_worker(self):
+        while True:
+            url = self._prefetch_queue.get()
+            if url is None:
+                return
+            if url in self.cache:
+                continue
+            try:
+                self._download(url)
+                self.log('Prefetched segment: %s' % url)
+            except requests.exceptions.RequestException as error:
+                self.log('Segment prefetch failed: %s' % error)
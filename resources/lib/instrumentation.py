@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Request-level timing for espnlib
+"""
+import json
+import time
+import threading
+from urlparse import urlparse
+
+from requests.adapters import HTTPAdapter
+# HTTPSConnection is urllib3's certificate verifying connection class
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+
+_local = threading.local()
+
+
+def _connection_events():
+    """Return the list collecting connection setups made by the current thread."""
+    if not hasattr(_local, 'connections'):
+        _local.connections = []
+    return _local.connections
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.time()
+        HTTPConnection.connect(self)
+        _connection_events().append({'host': self.host, 'connect': time.time() - start, 'tls': 0.0})
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def _new_conn(self):
+        start = time.time()
+        conn = HTTPSConnection._new_conn(self)
+        self._connect_time = time.time() - start
+        return conn
+
+    def connect(self):
+        start = time.time()
+        self._connect_time = None
+        HTTPSConnection.connect(self)
+        total = time.time() - start
+        connect_time = self._connect_time if self._connect_time is not None else total
+        _connection_events().append({'host': self.host, 'connect': connect_time, 'tls': total - connect_time})
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """An HTTPAdapter whose pools open connections that report their setup time."""
+
+    @staticmethod
+    def _instrument(pool):
+        if pool.scheme == 'https':
+            connection_class = TimedHTTPSConnection
+        else:
+            connection_class = TimedHTTPConnection
+        pool.ConnectionCls = connection_class
+        return pool
+
+    def get_connection(self, *args, **kwargs):
+        return self._instrument(HTTPAdapter.get_connection(self, *args, **kwargs))
+
+    if hasattr(HTTPAdapter, 'get_connection_with_tls_context'):
+        def get_connection_with_tls_context(self, *args, **kwargs):
+            return self._instrument(HTTPAdapter.get_connection_with_tls_context(self, *args, **kwargs))
+
+
+class Instrumentation(object):
+    """Collects a record for every HTTP request made during an action:
+    endpoint, status, payload size, connect (DNS + TCP), TLS, time to first
+    byte and total time, whether a pooled connection was reused, and the time
+    spent parsing the response."""
+
+    def __init__(self):
+        self.action = None
+        self.started = time.time()
+        self.records = []
+        self._lock = threading.Lock()
+
+    def begin_action(self, action):
+        """Start collecting records for a new action."""
+        with self._lock:
+            self.action = action
+            self.started = time.time()
+            self.records = []
+
+    def start_request(self):
+        """Mark the start of a request on the current thread."""
+        del _connection_events()[:]
+        _local.request_start = time.time()
+
+    def finish_request(self, method, url, response=None, size=None):
+        """Record the request started on the current thread. Return the record."""
+        total = time.time() - _local.request_start
+        connections = list(_connection_events())
+        record = {
+            'method': method,
+            'endpoint': urlparse(url).path,
+            'host': urlparse(url).netloc,
+            'status': response.status_code if response is not None else None,
+            'bytes': size,
+            'connect': sum(connection['connect'] for connection in connections),
+            'tls': sum(connection['tls'] for connection in connections),
+            'ttfb': response.elapsed.total_seconds() if response is not None else None,
+            'total': total,
+            'reused': not connections,
+            'parse': 0.0
+        }
+        _local.last_record = record
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def use_record(self, record):
+        """Attribute later parse time on the current thread to record, e.g. the
+        winner of requests sent from other threads."""
+        _local.last_record = record
+
+    def add_parse_time(self, seconds):
+        """Attribute parse time to the last request made on the current thread."""
+        record = getattr(_local, 'last_record', None)
+        if record is not None:
+            record['parse'] += seconds
+
+    def parse(self, func, *args, **kwargs):
+        """Return func(*args, **kwargs), timed as parsing of the last response."""
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.add_parse_time(time.time() - start)
+
+    def summary(self):
+        """Return a one-line summary of the current action, e.g.
+        'play_video: 5 requests, 1.80s, 1.20s in startSession'."""
+        with self._lock:
+            records = list(self.records)
+        duration = time.time() - self.started
+        text = '%s: %d requests, %.2fs' % (self.action, len(records), duration)
+        if records:
+            slowest = max(records, key=lambda record: record['total'])
+            text += ', %.2fs in %s' % (slowest['total'], slowest['endpoint'].rstrip('/').split('/')[-1] or '/')
+            new_connections = len([record for record in records if not record['reused']])
+            handshakes = len([record for record in records if record['tls']])
+            text += ', %d new connections, %d TLS handshakes' % (new_connections, handshakes)
+            hedged = len([record for record in records if record.get('hedged')])
+            if hedged:
+                text += ', %d hedged' % hedged
+        return text
+
+    def dump(self, path):
+        """Append the current action and its records as a JSON line to path."""
+        with self._lock:
+            entry = {'action': self.action, 'started': self.started, 'duration': time.time() - self.started,
+                     'requests': list(self.records)}
+        try:
+            with open(path, 'ab') as dump_file:
+                dump_file.write(json.dumps(entry) + '\n')
+        except IOError:
+            pass
+
+    @staticmethod
+    def tail_latency(path, action, percentiles=(50, 90, 99)):
+        """Return a dict with the given percentiles and the maximum ('max') of
+        the durations of action in a file written by dump(), plus the number of
+        runs ('count'). Return None if the action was never recorded."""
+        durations = []
+        try:
+            with open(path, 'rb') as dump_file:
+                for line in dump_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get('action') == action:
+                        durations.append(entry['duration'])
+        except IOError:
+            return None
+        if not durations:
+            return None
+        durations.sort()
+        latency = {'count': len(durations), 'max': durations[-1]}
+        for percentile in percentiles:
+            # nearest-rank percentile
+            rank = max(1, int(-(-percentile * len(durations) // 100)))
+            latency['p%d' % percentile] = durations[rank - 1]
+        return latency
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+A Kodi service that keeps the ESPN Player schedule cache warm
+"""
+import os
+
+from resources.lib.espnlib import espnlib, REFRESH_IDLE_MAX
+
+import xbmc
+import xbmcaddon
+import xbmcvfs
+
+addon = xbmcaddon.Addon()
+addon_profile = xbmc.translatePath(addon.getAddonInfo('profile'))
+logging_prefix = '[%s-%s-service]' % (addon.getAddonInfo('id'), addon.getAddonInfo('version'))
+
+if not xbmcvfs.exists(addon_profile):
+    xbmcvfs.mkdir(addon_profile)
+
+cookie_file = os.path.join(addon_profile, 'cookie_file')
+# seconds between checks for changed settings while waiting for the next refresh
+SETTINGS_POLL = 5
+
+
+class ServiceMonitor(xbmc.Monitor):
+    """A Monitor that remembers when the add-on settings changed."""
+
+    def __init__(self):
+        xbmc.Monitor.__init__(self)
+        self.settings_changed = False
+
+    def onSettingsChanged(self):
+        self.settings_changed = True
+
+
+def addon_log(string):
+    if addon.getSetting('debug') == 'true':
+        xbmc.log('%s: %s' % (logging_prefix, string))
+
+
+def create_espn(settings):
+    if settings.getSetting('schedule_next_month') == 'true':
+        schedule_window = (-1, 1)
+    else:
+        schedule_window = (-1, 0)
+    return espnlib(cookie_file, settings.getSetting('debug') == 'true', settings.getSetting('verify_ssl') != 'false',
+                   cache_dir=xbmc.translatePath(settings.getSetting('shared_cache_dir')) or addon_profile,
+                   schedule_window=schedule_window)
+
+
+def refresh(espn, settings):
+    """Refresh the schedules of all subscribed services. Return the seconds to wait.
+    The service never logs in itself: the schedules are public, and the
+    subscribed services are looked up with the session the plugin stored."""
+    if not settings.getSetting('email'):
+        return REFRESH_IDLE_MAX
+    # the plugin may have logged in (or out) since the last refresh
+    espn.cookie_jar.reload()
+    services = espn.get_services()
+    if not services:
+        addon_log('no subscribed services found, waiting for the plugin to log in')
+        return REFRESH_IDLE_MAX
+    return espn.refresh_schedules(services.values())
+
+
+def wait(monitor, seconds):
+    """Wait for up to seconds, returning early when the settings change.
+    Return True if Kodi is shutting down."""
+    remaining = seconds
+    while remaining > 0 and not monitor.settings_changed:
+        if monitor.waitForAbort(min(SETTINGS_POLL, remaining)):
+            return True
+        remaining -= SETTINGS_POLL
+    return False
+
+
+def run():
+    monitor = ServiceMonitor()
+    espn = create_espn(addon)
+    while not monitor.abortRequested():
+        settings = xbmcaddon.Addon()  # pick up changed settings
+        if monitor.settings_changed:
+            monitor.settings_changed = False
+            espn = create_espn(settings)
+        if settings.getSetting('background_refresh') == 'true':
+            try:
+                interval = refresh(espn, settings)
+            except Exception as error:
+                addon_log('schedule refresh failed: %s' % error)
+                interval = espn.refresh_interval
+        else:
+            interval = REFRESH_IDLE_MAX
+        if wait(monitor, interval):
+            break
+
+
+if __name__ == '__main__':
+    run()